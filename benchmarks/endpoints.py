@@ -0,0 +1,220 @@
+"""
+Benchmarks every endpoint of the orchestration node against in-process stand-ins for AWS, Cognito and PyGrid.
+
+For each endpoint it reports p50/p99 latency, throughput, response size and the AWS calls made per request (in
+total, by operation, and made in the background as a result of the requests), and how many of the model retrievals
+the requests started failed. Results are written as JSON; given a baseline from an earlier run, it exits non-zero if
+any retrieval failed, or an endpoint makes more AWS calls or got slower than the tolerance allows.
+
+    python -m benchmarks.endpoints --iterations 200 --output bench.json
+    python -m benchmarks.endpoints --baseline bench.json
+"""
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+from contextlib import redirect_stdout
+
+from .stand_ins import AwsCallCounter, PygridNodeStandIn, aws_stand_ins, seed, stand_in_cognito
+
+AUTH = {'Authorization': 'Bearer bench-token'}
+
+
+def percentile(latencies, p):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def scenarios(dataset_ids, model_ids, api_key):
+    """
+    (name, iterations factor, expected status, request(client, i)) for every endpoint.
+    Ordered so that the api key is only rotated once nothing else needs it.
+    """
+    dataset_id = dataset_ids[0]
+
+    def model(i):
+        return model_ids[i % len(model_ids)]
+
+    etags = {}
+
+    def info_not_modified(c, i):
+        # Polls with the tag of the current /info response, as a device that already has it would
+        if dataset_id not in etags:
+            response = c.post('/info', headers={'api_key': api_key}, json={'dataset_id': dataset_id})
+            etags[dataset_id] = response.headers['ETag']
+        return c.post('/info', headers={'api_key': api_key, 'If-None-Match': etags[dataset_id]},
+                      json={'dataset_id': dataset_id})
+
+    return [
+        ('status', 1, 200, lambda c, i: c.get('/')),
+        ('create', 1, 200, lambda c, i: c.post('/create', headers=AUTH, json={
+            'model_id': model(i), 'dataset_id': dataset_id, 'features': ['a', 'b'], 'labels': ['c'],
+        })),
+        ('info', 1, 200, lambda c, i: c.post('/info', headers={'api_key': api_key}, json={'dataset_id': dataset_id})),
+        ('info_not_modified', 1, 304, info_not_modified),
+        ('info_compact', 1, 200, lambda c, i: c.post('/info', json={'dataset_id': dataset_id}, headers={
+            'api_key': api_key, 'Accept': 'application/msgpack', 'Accept-Encoding': 'zstd, gzip',
+        })),
+        ('info_bad_key', 1, 400, lambda c, i: c.post('/info', headers={'api_key': 'wrong'}, json={'dataset_id': dataset_id})),
+        ('model_loss', 1, 200, lambda c, i: c.post('/model_loss', json={'model_id': model(i), 'loss': 0.5, 'acc': 0.9})),
+        ('model_loss_batch', 1, 200, lambda c, i: c.post('/model_loss_batch', json={'reports': [
+            {'model_id': model(i + r), 'loss': 0.5, 'acc': 0.9} for r in range(100)
+        ]})),
+        ('model_progress', 1, 200, lambda c, i: c.post('/model_progress', json={
+            'model_id': model(i), 'percent_complete': (i % 99) + 1,
+        })),
+        ('model_progress_complete', 0.1, 200, lambda c, i: c.post('/model_progress', json={
+            'model_id': model(i), 'percent_complete': 100,
+        })),
+        ('model_metrics', 1, 200, lambda c, i: c.post('/model_metrics', headers=AUTH, json={
+            'model_id': model(i), 'points': 100,
+        })),
+        ('get_datasets', 1, 200, lambda c, i: c.post('/get_datasets', headers=AUTH, json={'user_id': 'bench-scientist'})),
+        ('generate_key', 1, 200, lambda c, i: c.post('/generate_key', headers=AUTH, json={'user_id': 'bench-owner-id'})),
+    ]
+
+
+def drain(service):
+    """ Waits for the background work started by requests (buffered writes, model retrievals) to finish """
+    service.loss_buffer.flush()
+    while service.retrieval_queue.in_flight:
+        time.sleep(0.01)
+
+
+def run_scenario(service, counter, request, iterations, expected_status=200, warmup=5):
+    client = service.app.test_client()
+    failures = service.retrieval_queue.failures
+
+    # Warm up clients and caches, so the results describe the steady state
+    for i in range(warmup):
+        request(client, i)
+    drain(service)
+    counter.take_background()
+    counter.take()
+
+    latencies = []
+    errors = 0
+    response_bytes = 0
+    calls = Counter()
+
+    started = time.perf_counter()
+    for i in range(iterations):
+        request_started = time.perf_counter()
+        response = request(client, i)
+        latencies.append(time.perf_counter() - request_started)
+        calls.update(counter.take())
+        response_bytes += len(response.get_data())
+        if response.status_code != expected_status:
+            errors += 1
+    elapsed = time.perf_counter() - started
+
+    drain(service)
+    background = counter.take_background() + counter.take()
+
+    return {
+        'iterations': iterations,
+        'errors': errors,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'mean_ms': round(sum(latencies) / iterations * 1000, 3),
+        'throughput_rps': round(iterations / elapsed, 1),
+        'response_bytes': round(response_bytes / float(iterations), 1),
+        'aws_calls_per_request': round(sum(calls.values()) / float(iterations), 3),
+        'aws_calls_by_operation': {op: round(n / float(iterations), 3) for op, n in sorted(calls.items())},
+        'background_aws_calls_per_request': round(sum(background.values()) / float(iterations), 3),
+        'background_errors': service.retrieval_queue.failures - failures,
+    }
+
+
+def run(iterations=200, aws_latency_ms=0.0, checkpoint_size=1024 * 1024, models=10, features=20, only=None,
+        warmup=5):
+    counter = AwsCallCounter(latency=aws_latency_ms / 1000.0)
+    results = {}
+
+    # The service's debugging prints go to stderr, so that stdout only carries the results
+    with redirect_stdout(sys.stderr), aws_stand_ins(counter), PygridNodeStandIn(checkpoint_size=checkpoint_size):
+        from src import pygrid_orchestration as service
+        stand_in_cognito(service.app)
+
+        dataset_ids, model_ids, api_key = seed(models_per_dataset=models, features=features)
+        counter.take()
+
+        for name, factor, expected_status, request in scenarios(dataset_ids, model_ids, api_key):
+            if only and name not in only:
+                continue
+            results[name] = run_scenario(service, counter, request, max(1, int(iterations * factor)),
+                                         expected_status, warmup)
+            print(name, json.dumps(results[name]), file=sys.stderr)
+
+    return {
+        'config': {
+            'iterations': iterations,
+            'aws_latency_ms': aws_latency_ms,
+            'checkpoint_size': checkpoint_size,
+            'models': models,
+            'features': features,
+            'warmup': warmup,
+        },
+        'endpoints': results,
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Lists every endpoint whose background work failed, that makes more AWS calls, or whose p99 latency grew by more
+    than the tolerance
+    """
+    found = []
+    for name, result in results['endpoints'].items():
+        if result.get('background_errors'):
+            found.append(name + ': ' + str(result['background_errors']) + ' background model retrievals failed')
+
+        before = baseline.get('endpoints', {}).get(name)
+        if before is None:
+            continue
+
+        for metric in ('aws_calls_per_request', 'background_aws_calls_per_request'):
+            if result[metric] > before[metric]:
+                found.append(name + ': ' + metric + ' went from ' + str(before[metric]) + ' to ' + str(result[metric]))
+
+        if result['p99_ms'] > before['p99_ms'] * (1 + tolerance):
+            found.append(name + ': p99 went from ' + str(before['p99_ms']) + 'ms to ' + str(result['p99_ms']) + 'ms')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--aws-latency-ms', type=float, default=0.0,
+                        help='simulated round trip time added to every AWS call')
+    parser.add_argument('--checkpoint-size', type=int, default=1024 * 1024, help='bytes served by the pygrid stand-in')
+    parser.add_argument('--models', type=int, default=10, help='models on the benchmark dataset')
+    parser.add_argument('--features', type=int, default=20, help='features per model')
+    parser.add_argument('--warmup', type=int, default=5, help='unmeasured requests per endpoint before measuring')
+    parser.add_argument('--only', nargs='*', help='endpoints (scenario names) to run')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed relative p99 latency growth')
+    args = parser.parse_args()
+
+    results = run(args.iterations, args.aws_latency_ms, args.checkpoint_size, args.models, args.features, args.only,
+                  args.warmup)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            found = regressions(results, json.load(baseline), args.tolerance)
+        for regression in found:
+            print('REGRESSION', regression, file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
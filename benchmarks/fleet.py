@@ -0,0 +1,298 @@
+"""
+Simulates a fleet of app devices, and the pygrid nodes training on them, against the orchestration node: in process
+with stand-ins for AWS, Cognito and PyGrid (see stand_ins), or over http against a running service (--url).
+
+Devices poll /info with their dataset's api key every --poll-seconds, sending back the ETag they last got. Each pygrid
+node trains its dataset's models in cycles of --cycle-seconds: during a cycle, --participation of the dataset's devices
+report their loss to /model_loss, and at the end of it the node reports each model's progress to /model_progress
+(models that reach 100% are retrieved from the pygrid stand-in, and start over). Requests arrive on an open-loop
+schedule at the rates these imply, so a service that can't keep up shows it as growing latency (measured from when
+each request was due) rather than as a lower request rate.
+
+For each device count it reports the offered and achieved request rates, tail latencies and error rates, in total and
+per endpoint, the AWS calls made per request and the model retrievals that failed, as JSON:
+
+    python -m benchmarks.fleet --devices 100 1000 10000 100000 --duration 30 --output fleet.json
+"""
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+from .endpoints import drain, percentile
+from .stand_ins import AwsCallCounter, PygridNodeStandIn, aws_stand_ins, seed, stand_in_cognito
+
+
+class InProcess:
+    """ Sends requests to the service's WSGI app directly, with a test client per thread """
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def post(self, path, headers, body):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        response = client.post(path, headers=headers, json=body)
+        return response.status_code, response.headers.get('ETag')
+
+
+class OverHttp:
+    """ Sends requests to a running service, with a connection pool per thread """
+
+    def __init__(self, url, timeout=30):
+        import requests
+
+        self.requests = requests
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def post(self, path, headers, body):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = self.requests.Session()
+        try:
+            response = session.post(self.url + path, headers=headers, json=body, timeout=self.timeout)
+        except self.requests.RequestException:
+            return 0, None
+        return response.status_code, response.headers.get('ETag')
+
+
+class Fleet:
+    """
+    The devices and pygrid nodes of a simulation. Devices are spread evenly over the datasets, and each device trains
+    (and reports the loss of) a random model of its dataset.
+    """
+
+    def __init__(self, transport, devices, dataset_ids, model_ids, api_key, participation=0.1, progress_step=5,
+                 seed=0):
+        self.transport = transport
+        self.devices = devices
+        self.dataset_ids = dataset_ids
+        # Models are matched to datasets by name (<dataset_id>-...), as seed() names them; if none match, any will do
+        self.models = {dataset_id: [m for m in model_ids if m.startswith(dataset_id + '-')] or model_ids
+                       for dataset_id in dataset_ids}
+        self.model_ids = model_ids
+        self.api_key = api_key
+        self.participation = participation
+        self.progress_step = progress_step
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.etags = {}  # device -> ETag of its last /info response
+        self.progress = Counter()  # model_id -> percent complete of its current training run
+        self.next_model = 0
+
+    def rates(self, poll_seconds, cycle_seconds):
+        """ Requests per second to each endpoint """
+        return {
+            'info': self.devices / float(poll_seconds),
+            'model_loss': self.devices * self.participation / float(cycle_seconds),
+            'model_progress': len(self.model_ids) / float(cycle_seconds),
+        }
+
+    def request(self, endpoint):
+        """ Picks the sender of a request to the endpoint, returning a call that sends it and returns its status """
+        with self.lock:
+            if endpoint == 'model_progress':
+                # Nodes report on their models in turn
+                model_id = self.model_ids[self.next_model % len(self.model_ids)]
+                self.next_model += 1
+                percent = min(100, self.progress[model_id] + self.progress_step)
+                self.progress[model_id] = 0 if percent >= 100 else percent
+                return lambda: self.send('/model_progress', {'model_id': model_id, 'percent_complete': percent})
+
+            device = self.random.randrange(self.devices)
+            dataset_id = self.dataset_ids[device % len(self.dataset_ids)]
+            if endpoint == 'model_loss':
+                model_id = self.random.choice(self.models[dataset_id])
+                loss, acc = self.random.uniform(0.1, 2.0), self.random.uniform(0.1, 1.0)
+                return lambda: self.send('/model_loss', {'model_id': model_id, 'loss': loss, 'acc': acc})
+
+        return lambda: self.poll(device, dataset_id)
+
+    def poll(self, device, dataset_id):
+        headers = {'api_key': self.api_key}
+        etag = self.etags.get(device)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+
+        status, etag = self.transport.post('/info', headers, {'dataset_id': dataset_id})
+        if etag:
+            self.etags[device] = etag
+        return status
+
+    def send(self, path, body):
+        return self.transport.post(path, {}, body)[0]
+
+
+def run_step(fleet, duration, poll_seconds, cycle_seconds, concurrency, seed=0):
+    """
+    Sends the requests the fleet makes in `duration` seconds, as Poisson arrivals at the fleet's rates, and returns
+    the latencies and statuses of each endpoint's requests
+    """
+    rates = fleet.rates(poll_seconds, cycle_seconds)
+    total_rate = sum(rates.values())
+    arrivals = random.Random(seed)
+    endpoints = list(rates)
+    weights = [rates[endpoint] for endpoint in endpoints]
+
+    latencies = {endpoint: [] for endpoint in endpoints}
+    statuses = {endpoint: Counter() for endpoint in endpoints}
+    lock = threading.Lock()
+
+    def send(endpoint, call, due):
+        try:
+            status = call()
+        except BaseException:
+            status = 0  # counted as an error, like a connection failure
+        latency = time.perf_counter() - due
+        with lock:
+            latencies[endpoint].append(latency)
+            statuses[endpoint][status] += 1
+
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='fleet')
+    started = time.perf_counter()
+    offset = arrivals.expovariate(total_rate)
+    while offset < duration:
+        due = started + offset
+        wait = due - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+        endpoint = arrivals.choices(endpoints, weights)[0]
+        executor.submit(send, endpoint, fleet.request(endpoint), due)
+        offset += arrivals.expovariate(total_rate)
+
+    executor.shutdown(wait=True)
+    elapsed = time.perf_counter() - started
+    return rates, latencies, statuses, elapsed
+
+
+def summarize(latencies, statuses, elapsed, offered_rps=None):
+    requests = len(latencies)
+    errors = sum(n for status, n in statuses.items() if status == 0 or status >= 400)
+    summary = {
+        'requests': requests,
+        'throughput_rps': round(requests / elapsed, 1),
+        'errors': errors,
+        'error_rate': round(errors / float(requests), 4) if requests else 0.0,
+        'statuses': {str(status): n for status, n in sorted(statuses.items())},
+    }
+    if offered_rps is not None:
+        summary['offered_rps'] = round(offered_rps, 1)
+    if requests:
+        summary.update({
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'p999_ms': round(percentile(latencies, 99.9) * 1000, 3),
+            'max_ms': round(max(latencies) * 1000, 3),
+        })
+    return summary
+
+
+def simulate(transport, devices, dataset_ids, model_ids, api_key, args, service=None, counter=None):
+    fleet = Fleet(transport, devices, dataset_ids, model_ids, api_key, args.participation, args.progress_step,
+                  seed=args.seed)
+    failures = service.retrieval_queue.failures if service is not None else 0
+    rates, latencies, statuses, elapsed = run_step(fleet, args.duration, args.poll_seconds, args.cycle_seconds,
+                                                   args.concurrency, seed=args.seed)
+
+    step = summarize([l for endpoint in latencies.values() for l in endpoint],
+                     sum(statuses.values(), Counter()), elapsed, sum(rates.values()))
+    step['devices'] = devices
+    step['elapsed_s'] = round(elapsed, 3)
+    step['endpoints'] = {endpoint: summarize(latencies[endpoint], statuses[endpoint], elapsed, rates[endpoint])
+                         for endpoint in rates}
+
+    # Every AWS call made while the step ran, whether by requests or by the background work they caused
+    if service is not None and counter is not None:
+        drain(service)
+        calls = counter.take_background() + counter.take()
+        step['aws_calls_per_request'] = round(sum(calls.values()) / float(max(1, step['requests'])), 3)
+        step['aws_calls_by_operation'] = {op: n for op, n in sorted(calls.items())}
+        step['background_errors'] = service.retrieval_queue.failures - failures
+    return step
+
+
+def run(args):
+    results = {'config': vars(args), 'steps': []}
+
+    if args.url:
+        transport = OverHttp(args.url, timeout=args.timeout)
+        for devices in args.devices:
+            step = simulate(transport, devices, args.dataset_ids, args.model_ids, args.api_key, args)
+            results['steps'].append(step)
+            print(devices, 'devices', json.dumps(step), file=sys.stderr)
+        return results
+
+    counter = AwsCallCounter(latency=args.aws_latency_ms / 1000.0)
+
+    # The service's debugging prints go to stderr, so that stdout only carries the results
+    with redirect_stdout(sys.stderr), aws_stand_ins(counter), \
+            PygridNodeStandIn(checkpoint_size=args.checkpoint_size, unique_checkpoints=True):
+        from src import pygrid_orchestration as service
+        stand_in_cognito(service.app)
+
+        dataset_ids, model_ids, api_key = seed(datasets=args.datasets, models_per_dataset=args.models)
+        transport = InProcess(service.app)
+        for devices in args.devices:
+            counter.take_background()
+            counter.take()
+            step = simulate(transport, devices, dataset_ids, model_ids, api_key, args, service, counter)
+            results['steps'].append(step)
+            print(devices, 'devices', json.dumps(step), file=sys.stderr)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--devices', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='device counts to simulate, one step each')
+    parser.add_argument('--duration', type=float, default=30, help='seconds each step runs for')
+    parser.add_argument('--poll-seconds', type=float, default=30, help='how often each device polls /info')
+    parser.add_argument('--cycle-seconds', type=float, default=60, help='length of a training cycle')
+    parser.add_argument('--participation', type=float, default=0.1,
+                        help='share of a dataset\'s devices that train (and report their loss) in each cycle')
+    parser.add_argument('--progress-step', type=int, default=5, help='percent a model progresses per cycle')
+    parser.add_argument('--concurrency', type=int, default=64, help='requests in flight at most')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the arrival schedule and device choices')
+    parser.add_argument('--output', help='write the results to this file instead of stdout')
+
+    local = parser.add_argument_group('in process (the default)')
+    local.add_argument('--datasets', type=int, default=10, help='datasets (each with a pygrid node)')
+    local.add_argument('--models', type=int, default=5, help='models per dataset')
+    local.add_argument('--aws-latency-ms', type=float, default=0.0,
+                       help='simulated round trip time added to every AWS call')
+    local.add_argument('--checkpoint-size', type=int, default=1024 * 1024,
+                       help='bytes of each checkpoint served by the pygrid stand-in')
+
+    remote = parser.add_argument_group('over http')
+    remote.add_argument('--url', help='base url of a running orchestration node')
+    remote.add_argument('--api-key', help='api key of the datasets\' owner')
+    remote.add_argument('--dataset-ids', nargs='+', help='datasets the devices belong to')
+    remote.add_argument('--model-ids', nargs='+', help='models being trained on those datasets')
+    remote.add_argument('--timeout', type=float, default=30, help='seconds before a request counts as failed')
+    args = parser.parse_args()
+
+    if args.url and not (args.api_key and args.dataset_ids and args.model_ids):
+        parser.error('--url needs --api-key, --dataset-ids and --model-ids')
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
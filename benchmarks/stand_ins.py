@@ -0,0 +1,225 @@
+"""
+In-process stand-ins for everything the orchestration node talks to: DynamoDB, S3 and CloudFormation (via moto),
+Cognito, and a PyGrid node's retrieve-model endpoint. Every AWS call the service makes is counted per thread.
+"""
+import os
+import hashlib
+import threading
+import time
+import http.server
+import urllib.parse
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    from moto import mock_aws
+except ImportError:  # moto < 5
+    from moto import mock_dynamodb, mock_s3, mock_cloudformation
+
+    @contextmanager
+    def mock_aws():
+        with mock_dynamodb(), mock_s3(), mock_cloudformation():
+            yield
+
+from src import aws_clients
+
+BUCKET = 'artificien-retrieved-models-storage'
+OWNER = 'bench-owner'
+SCIENTIST = 'bench-scientist'
+
+
+class AwsCallCounter:
+    """
+    Counts the AWS operations made by each thread, optionally adding a fixed round trip latency to each. Calls fanned
+    out by a request (see AwsClients.fan_out) are counted as the requesting thread's.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = {}  # thread id -> Counter of 'service.Operation'
+
+    def before_call(self, event_name, **kwargs):
+        _, service, operation = event_name.split('.', 2)
+        caller = threading.current_thread()
+        key = 'fan-out' if caller.name.startswith('aws-fan-out') else caller.ident
+        with self.lock:
+            self.calls.setdefault(key, Counter())[service + '.' + operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def take(self, thread_id=None):
+        """ Returns and resets the calls of a thread (by default the current one), with any it fanned out """
+        with self.lock:
+            return self.calls.pop(thread_id or threading.get_ident(), Counter()) + self.calls.pop('fan-out', Counter())
+
+    def take_background(self):
+        """ Returns and resets the calls of every other thread, e.g. background workers """
+        with self.lock:
+            own = self.calls.pop(threading.get_ident(), None)
+            total = Counter()
+            for calls in self.calls.values():
+                total.update(calls)
+            self.calls = {} if own is None else {threading.get_ident(): own}
+            return total
+
+
+def create_tables():
+    ddb = aws_clients.aws.client('dynamodb')
+    ddb.create_table(
+        TableName='model_table',
+        KeySchema=[{'AttributeName': 'model_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'model_id', 'AttributeType': 'S'},
+                              {'AttributeName': 'dataset', 'AttributeType': 'S'}],
+        GlobalSecondaryIndexes=[{'IndexName': 'models_dataset_index',
+                                 'KeySchema': [{'AttributeName': 'dataset', 'KeyType': 'HASH'}],
+                                 'Projection': {'ProjectionType': 'ALL'}}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    ddb.create_table(
+        TableName='dataset_table',
+        KeySchema=[{'AttributeName': 'dataset_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'dataset_id', 'AttributeType': 'S'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    ddb.create_table(
+        TableName='user_table',
+        KeySchema=[{'AttributeName': 'user_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[{'AttributeName': 'user_id', 'AttributeType': 'S'},
+                              {'AttributeName': 'username', 'AttributeType': 'S'}],
+        GlobalSecondaryIndexes=[{'IndexName': 'users_username_index',
+                                 'KeySchema': [{'AttributeName': 'username', 'KeyType': 'HASH'}],
+                                 'Projection': {'ProjectionType': 'ALL'}}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    ddb.create_table(
+        TableName='model_metrics_table',
+        KeySchema=[{'AttributeName': 'model_id', 'KeyType': 'HASH'}, {'AttributeName': 'bucket', 'KeyType': 'RANGE'}],
+        AttributeDefinitions=[{'AttributeName': 'model_id', 'AttributeType': 'S'},
+                              {'AttributeName': 'bucket', 'AttributeType': 'N'}],
+        BillingMode='PAY_PER_REQUEST',
+    )
+    for table_name in ('node_pool_table', 'shared_node_table'):
+        ddb.create_table(
+            TableName=table_name,
+            KeySchema=[{'AttributeName': 'node_id', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'node_id', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST',
+        )
+    aws_clients.s3().create_bucket(Bucket=BUCKET)
+
+
+def seed(datasets=1, models_per_dataset=10, features=20, node_url='127.0.0.1'):
+    """
+    Creates an app developer (OWNER) with an api key, datasets with running nodes, and a data scientist (SCIENTIST)
+    who has bought every dataset and owns all of their models. Returns the dataset ids, model ids and api key.
+    """
+    api_key = 'bench-api-key'
+    dataset_ids = ['bench-dataset-' + str(d) for d in range(datasets)]
+    model_ids = []
+
+    aws_clients.table('user_table').put_item(Item={
+        'user_id': 'bench-owner-id', 'username': OWNER, 'api_key': api_key, 'datasets_purchased': [],
+    })
+    aws_clients.table('user_table').put_item(Item={
+        'user_id': 'bench-scientist-id', 'username': SCIENTIST, 'datasets_purchased': dataset_ids,
+    })
+
+    for dataset_id in dataset_ids:
+        aws_clients.table('dataset_table').put_item(Item={
+            'dataset_id': dataset_id, 'owner_username': OWNER, 'properlySetUp': True,
+            'hasNode': True, 'nodeURL': node_url,
+        })
+        for m in range(models_per_dataset):
+            model_id = dataset_id + '-model-' + str(m)
+            model_ids.append(model_id)
+            aws_clients.table('model_table').put_item(Item={
+                'model_id': model_id, 'dataset': dataset_id, 'owner_name': SCIENTIST, 'version': '1.0',
+                'features': ['feature_' + str(f) for f in range(features)], 'labels': ['label'],
+                'percent_complete': 0, 'devices_trained_this_cycle': 0, 'node_URL': node_url,
+            })
+
+    return dataset_ids, model_ids, api_key
+
+
+@contextmanager
+def aws_stand_ins(counter=None):
+    """ Points the service's AWS clients at in-process stand-ins for the duration of the block """
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+    os.environ.setdefault('AWS_DEFAULT_REGION', aws_clients.region_name)
+    os.environ.setdefault('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')  # chunked checksums confuse moto
+
+    with mock_aws():
+        aws_clients.aws.reset()
+        if counter is not None:
+            aws_clients.aws.get_session().events.register('before-call', counter.before_call)
+        create_tables()
+        if counter is not None:
+            counter.take()
+        try:
+            yield
+        finally:
+            aws_clients.aws.reset()
+
+
+def stand_in_cognito(app, username=SCIENTIST):
+    """ Accepts any bearer token as a verified Cognito token for the given user """
+    app.extensions['cognito_auth'].verify_token = lambda token: {
+        'username': username, 'cognito:username': username, 'exp': int(time.time()) + 3600,
+    }
+
+
+class PygridNodeStandIn:
+    """
+    Serves PyGrid's /model-centric/retrieve-model endpoint with a random checkpoint of checkpoint_size bytes
+    (honouring Range requests). With unique_checkpoints, every model and version gets a checkpoint of its own, as
+    they would from real nodes. The orchestration node always calls pygrid nodes on port 5000.
+    """
+
+    def __init__(self, checkpoint_size=1024 * 1024, host='127.0.0.1', port=5000, unique_checkpoints=False):
+        self.checkpoint = os.urandom(checkpoint_size)
+        self.unique_checkpoints = unique_checkpoints
+        self.requests = 0
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.requests += 1
+                if not self.path.startswith('/model-centric/retrieve-model'):
+                    self.send_error(404)
+                    return
+
+                start = 0
+                byte_range = self.headers.get('Range')
+                if byte_range:
+                    start = int(byte_range.split('=')[1].split('-')[0])
+                query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                checkpoint = stand_in.checkpoint_of(query.get('name', [''])[0], query.get('version', [''])[0])
+                body = checkpoint[start:]
+
+                self.send_response(206 if byte_range else 200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='pygrid-stand-in', daemon=True)
+
+    def checkpoint_of(self, name, version):
+        if not self.unique_checkpoints:
+            return self.checkpoint
+        prefix = hashlib.sha256((name + '-' + version).encode('utf-8')).digest()
+        return prefix + self.checkpoint[len(prefix):]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
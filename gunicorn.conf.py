@@ -0,0 +1,27 @@
+# Loaded by gunicorn from the working directory (/app in the docker image)
+import os
+import shutil
+
+# Every worker writes its metrics to files in this directory, so /metrics can report all of them (see src/metrics.py)
+prometheus_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/prometheus_multiproc')
+os.environ.setdefault('prometheus_multiproc_dir', prometheus_dir)  # the name older prometheus_client versions read
+
+
+def on_starting(server):
+    shutil.rmtree(prometheus_dir, ignore_errors=True)
+    os.makedirs(prometheus_dir)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+# SERVING_MODE=async serves each worker's requests on gevent greenlets instead of one request per sync worker. Gunicorn
+# monkey patches the worker before loading the app, so boto3, requests and our background threads all yield while they
+# wait on the network, and one worker can hold thousands of devices polling /info at once
+if os.getenv('SERVING_MODE', 'sync') == 'async':
+    worker_class = 'gevent'
+    worker_connections = int(os.getenv('WORKER_CONNECTIONS', '1000'))
+    # Concurrent requests share each client's connection pool, so let it grow with them (see src/aws_clients.py)
+    os.environ.setdefault('AWS_MAX_POOL_CONNECTIONS', os.getenv('WORKER_CONNECTIONS', '1000'))
@@ -0,0 +1,138 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask_cognito import CognitoAuth
+from .cache_helper import TTLCache
+
+
+def hash_api_key(api_key):
+    """ API keys are only ever held in memory as hashes """
+    return hashlib.sha256(api_key.encode('utf-8')).hexdigest()
+
+
+class ApiKeyCache:
+    """
+    Caches the result of verifying an api key against a dataset, keyed by (dataset_id, hashed api_key).
+    Valid keys are remembered for ttl seconds and invalid keys for negative_ttl seconds. Entries are tracked
+    per dataset owner, so that all of them can be dropped when the owner rotates their key.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300.0, negative_ttl=30.0):
+        self.results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.owners = {}  # owner_username -> set of cache keys
+
+    def get(self, dataset_id, api_key):
+        """ Returns True/False for a cached verification result, or None if the key must be verified """
+        return self.results.get((dataset_id, hash_api_key(api_key)))
+
+    def set(self, dataset_id, api_key, owner_username, valid):
+        key = (dataset_id, hash_api_key(api_key))
+        self.results.set(key, valid, ttl=None if valid else self.negative_ttl)
+
+        with self.lock:
+            # Forget keys that have since been evicted, so the owner index stays bounded by the cache
+            keys = {k for k in self.owners.get(owner_username, ()) if k in self.results}
+            keys.add(key)
+            self.owners[owner_username] = keys
+
+    def invalidate_owner(self, owner_username):
+        """ Drops every cached result for datasets owned by a user, e.g. after their api key changed """
+        with self.lock:
+            keys = self.owners.pop(owner_username, ())
+
+        for key in keys:
+            self.results.invalidate(key)
+
+
+class TokenCache:
+    """
+    Caches the claims of verified Cognito tokens, keyed by the token's hash. An entry never outlives its token: it
+    expires after ttl seconds or when the token does, whichever is first. Only successful verifications are cached.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300.0):
+        self.claims = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, token):
+        return self.claims.get(hash_api_key(token))
+
+    def set(self, token, claims):
+        ttl = min(self.claims.ttl, float(claims.get('exp', 0)) - time.time())
+        if ttl > 0:
+            self.claims.set(hash_api_key(token), claims, ttl=ttl)
+
+
+class CachedCognitoAuth(CognitoAuth):
+    """ CognitoAuth that only verifies a token's signature the first time it sees the token """
+
+    def __init__(self, app=None, token_cache=None):
+        self.token_cache = token_cache or TokenCache()
+        super().__init__(app)
+
+    def decode_token(self, token):
+        claims = self.token_cache.get(token)
+        if claims is None:
+            claims = self.verify_token(token)
+            self.token_cache.set(token, claims)
+        return claims
+
+    def verify_token(self, token):
+        return super().decode_token(token)
+
+
+class EntitlementCache:
+    """
+    Caches what a user is entitled to (e.g. the datasets they purchased), as returned by load(username).
+
+    Entries are served for up to ttl seconds. Once an entry is older than refresh_after seconds, it is still served,
+    but reloaded in the background, so that users who keep calling never wait on the lookup. A caller that finds an
+    entitlement missing should reload() them, as it may just have been granted.
+    """
+
+    def __init__(self, load, maxsize=10000, ttl=600.0, refresh_after=60.0):
+        self.load = load
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)  # username -> (load time, entitlements)
+        self.refresh_after = refresh_after
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='entitlements')
+
+    def get(self, username):
+        entry = self.entries.get(username)
+        if entry is None:
+            return self.reload(username)
+
+        loaded, entitlements = entry
+        if time.monotonic() - loaded > self.refresh_after:
+            with self.lock:
+                stale = username not in self.refreshing
+                self.refreshing.add(username)
+            if stale:
+                self.executor.submit(self.refresh, username)
+        return entitlements
+
+    def reload(self, username, min_age=0):
+        """ Loads a user's entitlements afresh, unless they were loaded less than min_age seconds ago """
+        entry = self.entries.get(username)
+        if entry is not None and time.monotonic() - entry[0] < min_age:
+            return entry[1]
+
+        loaded = time.monotonic()
+        entitlements = self.load(username)
+        self.entries.set(username, (loaded, entitlements))
+        return entitlements
+
+    def refresh(self, username):
+        try:
+            self.reload(username)
+        except BaseException as exe:
+            print('Failed to refresh the entitlements of', username, exe)
+        finally:
+            with self.lock:
+                self.refreshing.discard(username)
+
+    def invalidate(self, username):
+        self.entries.invalidate(username)
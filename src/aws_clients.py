@@ -0,0 +1,130 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+
+region_name = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+def client_config():
+    """
+    Connection pool, timeout and retry settings shared by every AWS client. The pool should be at least as large as
+    the number of threads in a worker that talk to AWS at the same time, or requests queue for a connection.
+    """
+    options = {
+        'region_name': region_name,
+        'max_pool_connections': int(os.getenv('AWS_MAX_POOL_CONNECTIONS', '50')),
+        'connect_timeout': float(os.getenv('AWS_CONNECT_TIMEOUT', '5')),
+        'read_timeout': float(os.getenv('AWS_READ_TIMEOUT', '30')),
+        'retries': {
+            'max_attempts': int(os.getenv('AWS_MAX_ATTEMPTS', '5')),
+            'mode': os.getenv('AWS_RETRY_MODE', 'adaptive'),  # adaptive also rate limits us client side when throttled
+        },
+    }
+
+    # Pooled connections are kept alive between requests; TCP keepalive probes need a newer botocore
+    if 'tcp_keepalive' in Config.OPTION_DEFAULTS:
+        options['tcp_keepalive'] = os.getenv('AWS_TCP_KEEPALIVE', 'True') == 'True'
+
+    return Config(**options)
+
+
+class AwsClients:
+    """
+    Owns the AWS clients of a worker process. Each client (and its connection pool) is created once, on first use,
+    and then shared by every thread, so hot paths never pay for client construction or fresh TLS handshakes.
+    """
+
+    def __init__(self):
+        self.handlers = []  # (event name, handler) registered on every session
+        self.reset()
+
+    def reset(self):
+        """ Drops every client. Connection pools can't be shared with a forked child process """
+        self.lock = threading.Lock()
+        self.executor = None
+        self.session = None
+        self.clients = {}
+        self.resources = {}
+        self.tables = {}
+
+    def get_session(self):
+        if self.session is None:
+            session = boto3.session.Session(region_name=region_name)
+            for event_name, handler in self.handlers:
+                session.events.register(event_name, handler)
+            self.session = session
+        return self.session
+
+    def register(self, event_name, handler):
+        """ Registers a botocore event handler on every client, including those created after a reset """
+        self.handlers.append((event_name, handler))
+        if self.session is not None:
+            self.session.events.register(event_name, handler)
+
+    def client(self, service_name):
+        client = self.clients.get(service_name)
+        if client is None:
+            with self.lock:
+                client = self.clients.get(service_name)
+                if client is None:
+                    client = self.get_session().client(service_name, config=client_config())
+                    self.clients[service_name] = client
+        return client
+
+    def resource(self, service_name):
+        resource = self.resources.get(service_name)
+        if resource is None:
+            with self.lock:
+                resource = self.resources.get(service_name)
+                if resource is None:
+                    resource = self.get_session().resource(service_name, config=client_config())
+                    self.resources[service_name] = resource
+        return resource
+
+    def fan_out(self, *calls):
+        """
+        Makes independent calls concurrently and returns their results in order, raising the first failure. Under the
+        gevent workers of the async serving mode the pool's threads are greenlets, so this costs next to nothing.
+        """
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=int(os.getenv('AWS_FAN_OUT_WORKERS', '32')),
+                                                       thread_name_prefix='aws-fan-out')
+
+        # The calling thread makes the first call itself
+        futures = [self.executor.submit(call) for call in calls[1:]]
+        first = calls[0]()
+        return [first] + [future.result() for future in futures]
+
+    def table(self, table_name):
+        """ DynamoDB tables, which all share the dynamodb resource's client """
+        table = self.tables.get(table_name)
+        if table is None:
+            table = self.resource('dynamodb').Table(table_name)
+            self.tables[table_name] = table
+        return table
+
+
+aws = AwsClients()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=aws.reset)
+
+
+def table(table_name):
+    return aws.table(table_name)
+
+
+def fan_out(*calls):
+    return aws.fan_out(*calls)
+
+
+def s3():
+    return aws.client('s3')
+
+
+def cloudformation():
+    return aws.client('cloudformation')
@@ -1,22 +1,23 @@
 #!/usr/bin/env python3
 # This script runs all post-deployment actions - actions which are not directly orchestrated by AWS or the CDK
-import boto3
+import threading
+import time
 from botocore.exceptions import ClientError
+from . import aws_clients
+
+# Stack statuses which mean a stack was deployed, or won't be
+COMPLETE_STATUSES = {'CREATE_COMPLETE', 'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE'}
+FAILED_STATUSES = {'CREATE_FAILED', 'ROLLBACK_IN_PROGRESS', 'ROLLBACK_FAILED', 'ROLLBACK_COMPLETE',
+                   'DELETE_IN_PROGRESS', 'DELETE_FAILED', 'DELETE_COMPLETE'}
 
 
 def get_outputs(stack_name: str):
     """ Helper function to get CfnOutputs from deployed stacks"""
     try:
-        outputs = boto3.Session().client("cloudformation").describe_stacks(
+        outputs = aws_clients.cloudformation().describe_stacks(
             StackName=stack_name)["Stacks"][0]["Outputs"]
 
-        output_dict = {}
-        for output in outputs:
-            key = output['OutputKey']
-            value = output['OutputValue']
-            output_dict[key] = value
-
-        return output_dict
+        return outputs_to_dict(outputs)
 
     except ClientError:
         print('Cloudformation Stack might not be deployed yet')
@@ -25,3 +26,111 @@ def get_outputs(stack_name: str):
     except KeyError:
         print('Cloudformation Outputs for the', stack_name, 'stack are not properly configured')
         return None
+
+
+def outputs_to_dict(outputs):
+    output_dict = {}
+    for output in outputs:
+        key = output['OutputKey']
+        value = output['OutputValue']
+        output_dict[key] = value
+
+    return output_dict
+
+
+class StackTracker:
+    """
+    Tracks the deployment of stacks from a single background loop, so that clients polling for a node never turn into
+    CloudFormation calls of their own. Every in-flight stack is described once per poll interval, and the interval
+    backs off exponentially while CloudFormation is throttling us. Once a stack is complete its outputs are cached
+    and on_complete(stack_name, outputs) is called; if it fails to deploy, on_failed(stack_name, status) is called.
+    """
+
+    def __init__(self, on_complete=None, on_failed=None, poll_interval=10.0, max_interval=300.0, max_age=3600.0):
+        self.on_complete = on_complete
+        self.on_failed = on_failed
+        self.poll_interval = poll_interval
+        self.max_interval = max_interval
+        self.max_age = max_age  # how long to wait for a stack that doesn't exist (yet)
+        self.interval = poll_interval
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.in_flight = {}  # stack_name -> time it started being tracked
+        self.completed = {}  # stack_name -> outputs
+        self.thread = None
+
+    def watch(self, stack_name):
+        """ Starts tracking a stack, unless it is already tracked or complete """
+        with self.lock:
+            if stack_name in self.completed or stack_name in self.in_flight:
+                return
+            self.in_flight[stack_name] = time.monotonic()
+
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='stack-tracker', daemon=True)
+                self.thread.start()
+
+        self.wakeup.set()
+
+    def outputs(self, stack_name):
+        """ Returns the outputs of a completed stack. If the stack isn't known to be complete, starts tracking it """
+        output_dict = self.completed.get(stack_name)
+        if output_dict is None:
+            self.watch(stack_name)
+        return output_dict
+
+    def forget(self, stack_name):
+        with self.lock:
+            self.in_flight.pop(stack_name, None)
+            self.completed.pop(stack_name, None)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.poll()
+            except BaseException as exe:
+                print('Failed to poll cloudformation stacks:', exe)
+
+    def poll(self):
+        with self.lock:
+            stacks = list(self.in_flight.items())
+
+        for stack_name, since in stacks:
+            try:
+                stack = aws_clients.cloudformation().describe_stacks(StackName=stack_name)['Stacks'][0]
+            except ClientError as exe:
+                error = exe.response['Error']
+                if error['Code'] == 'Throttling':
+                    self.interval = min(self.interval * 2, self.max_interval)
+                    print('Cloudformation is throttling stack polling, backing off to', self.interval, 'seconds')
+                    return
+
+                # The stack might not have been launched yet
+                if time.monotonic() - since > self.max_age:
+                    self.finish(stack_name, None, 'DOES_NOT_EXIST')
+                continue
+
+            self.interval = self.poll_interval
+            status = stack['StackStatus']
+            if status in COMPLETE_STATUSES:
+                self.finish(stack_name, outputs_to_dict(stack.get('Outputs', [])), status)
+            elif status in FAILED_STATUSES:
+                self.finish(stack_name, None, status)
+
+    def finish(self, stack_name, outputs, status):
+        with self.lock:
+            self.in_flight.pop(stack_name, None)
+            if outputs is not None:
+                self.completed[stack_name] = outputs
+
+        if outputs is not None:
+            print('Stack', stack_name, 'is deployed')
+            if self.on_complete is not None:
+                self.on_complete(stack_name, outputs)
+        else:
+            print('Stack', stack_name, 'failed to deploy:', status)
+            if self.on_failed is not None:
+                self.on_failed(stack_name, status)
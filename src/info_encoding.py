@@ -0,0 +1,122 @@
+import gzip
+import json
+import hashlib
+import threading
+from .cache_helper import TTLCache
+
+try:
+    import msgpack
+except ImportError:  # /info is only served as JSON
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # /info is only compressed with gzip
+    zstandard = None
+
+JSON = 'application/json'
+MSGPACK = 'application/msgpack'
+
+# Compression levels: fast enough to encode each dataset's response once per version, small enough for cellular links
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+
+def media_types():
+    """ The media types /info can be served as. JSON comes first, so that clients that accept anything get JSON """
+    if msgpack is None:
+        return [JSON]
+    return [JSON, MSGPACK, 'application/x-msgpack']
+
+
+def content_codings():
+    """ The compressions /info can be served with, most compact first """
+    if zstandard is None:
+        return ['gzip']
+    return ['zstd', 'gzip']
+
+
+def negotiate(request):
+    """ Picks the (media type, content coding or None) to answer a request with, from its Accept and Accept-Encoding """
+    media_type = request.accept_mimetypes.best_match(media_types(), default=JSON)
+    coding = request.accept_encodings.best_match(content_codings())
+    return media_type, coding
+
+
+def encode(content, media_type):
+    if media_type == JSON:
+        # As jsonify would
+        return (json.dumps(content, separators=(',', ':'), sort_keys=True, default=str) + '\n').encode('utf-8')
+    return msgpack.packb(content, use_bin_type=True, default=str)
+
+
+def compress(body, coding):
+    if coding == 'zstd':
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    if coding == 'gzip':
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    return body
+
+
+class InfoVersion:
+    """
+    One version of a dataset's /info response (its models and node), and its representations encoded so far. Each is
+    a (etag, body) pair. The JSON representation without compression has the version's plain etag, as /info always
+    had; every other representation's etag is suffixed with its encoding.
+    """
+
+    def __init__(self, rmodels, node_url):
+        self.rmodels = rmodels
+        self.node_url = node_url
+        self.content = {'models': rmodels, 'nodeURL': node_url}
+
+        # The version tag changes whenever the models served or the node do
+        tagged = json.dumps([rmodels, node_url], sort_keys=True, default=str)
+        self.etag = hashlib.sha256(tagged.encode('utf-8')).hexdigest()[:32]
+
+        self.lock = threading.Lock()
+        self.representations = {}  # (media type, coding) -> (etag, body)
+
+    def etag_of(self, media_type, coding):
+        etag = self.etag
+        if media_type != JSON:
+            etag += '-msgpack'
+        if coding is not None:
+            etag += '-' + coding
+        return etag
+
+    def representation(self, media_type, coding):
+        """ The (etag, body) of the response as media_type compressed with coding, encoding it on first use """
+        representation = self.representations.get((media_type, coding))
+        if representation is not None:
+            return representation
+
+        representation = (self.etag_of(media_type, coding), compress(encode(self.content, media_type), coding))
+        with self.lock:
+            return self.representations.setdefault((media_type, coding), representation)
+
+
+class InfoResponses:
+    """
+    Caches the encoded /info responses of each dataset for as long as its models and node stay the same. The models
+    must come from the trainable models cache, which hands out the same list until they change, so telling whether
+    they did is an identity check rather than a comparison.
+    """
+
+    def __init__(self, maxsize=4096, ttl=30.0):
+        self.versions = TTLCache(maxsize=maxsize, ttl=ttl)  # dataset_id -> InfoVersion
+
+    def current(self, dataset_id):
+        """ The dataset's last known version, if any """
+        return self.versions.get(dataset_id)
+
+    def version(self, dataset_id, rmodels, node_url):
+        """ The dataset's version serving rmodels on node_url """
+        version = self.versions.get(dataset_id)
+        if version is None or version.rmodels is not rmodels or version.node_url != node_url:
+            version = InfoVersion(rmodels, node_url)
+            self.versions.set(dataset_id, version)
+        return version
+
+    def invalidate(self, dataset_id):
+        self.versions.invalidate(dataset_id)
@@ -0,0 +1,124 @@
+import threading
+import time
+from decimal import Decimal
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from . import aws_clients
+
+
+def add_cycle_reports(model_table, model_id, devices, loss_sum, acc_sum, return_values='NONE'):
+    """
+    Atomically adds a number of device reports to a model's running cycle sums, and records when the model was last
+    reported on. Raises ClientError (ConditionalCheckFailedException) if the model doesn't exist.
+    """
+    return model_table.update_item(
+        Key={'model_id': model_id},
+        UpdateExpression='ADD devices_trained_this_cycle :devices, loss_sum_this_cycle :loss, '
+                         'acc_sum_this_cycle :acc SET last_report = :now',
+        ConditionExpression=Attr('model_id').exists(),
+        ExpressionAttributeValues={
+            ':devices': devices,
+            ':loss': Decimal(str(loss_sum)),
+            ':acc': Decimal(str(acc_sum)),
+            ':now': int(time.time()),
+        },
+        ReturnValues=return_values,
+    )
+
+
+class LossBuffer:
+    """
+    Combines loss/acc reports per model in memory and flushes them to the model table as one UpdateItem per
+    model, once max_reports reports are pending or flush_interval seconds have passed since the last flush.
+    A burst of N reports therefore costs one write per model instead of one per report.
+    """
+
+    def __init__(self, table_name='model_table', max_reports=500, flush_interval=1.0):
+        self.table_name = table_name
+        self.max_reports = max_reports
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = {}  # model_id -> [devices, loss_sum, acc_sum]
+        self.pending_reports = 0
+        self.thread = None
+
+    def add(self, model_id, loss, acc, devices=1):
+        """ Buffers report(s) for a model. loss and acc are sums over the given number of devices """
+        self.merge(model_id, devices, loss, acc)
+        self.start()
+        if self.pending_reports >= self.max_reports:
+            self.wakeup.set()
+
+    def start(self):
+        """ Lazily starts the flusher thread, so that it lives in the (forked) worker process that uses it """
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='loss-buffer-flusher', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except BaseException as exe:
+                print('Failed to flush buffered model losses:', exe)
+
+    def flush(self):
+        """ Writes all pending reports to the model table. Reports that fail to write are put back in the buffer """
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.pending_reports = 0
+
+            for model_id, totals in pending.items():
+                self.write(model_id, *totals)
+
+    def flush_model(self, model_id):
+        """
+        Writes the pending reports of one model to the model table, e.g. before its cycle counters are reset, so that
+        they count towards the cycle they were made in. Reports buffered by other processes are not flushed
+        """
+        with self.flush_lock:
+            with self.lock:
+                totals = self.pending.pop(model_id, None)
+                if totals is None:
+                    return
+                self.pending_reports -= totals[0]
+
+            self.write(model_id, *totals)
+
+    def write(self, model_id, devices, loss_sum, acc_sum):
+        """
+        Adds a model's totals to the model table. Totals that fail to write are put back in the buffer, unless they
+        never could be written (the model is gone, or they can't be encoded), in which case they are dropped
+        """
+        try:
+            add_cycle_reports(aws_clients.table(self.table_name), model_id, devices, loss_sum, acc_sum)
+        except ClientError as exe:
+            if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                print('Dropping', devices, 'buffered reports for unknown model', model_id)
+                return
+            print('Failed to flush reports for model', model_id, exe)
+            self.merge(model_id, devices, loss_sum, acc_sum)
+        except Exception as exe:
+            print('Dropping', devices, 'buffered reports for model', model_id, 'that could not be written:', exe)
+
+    def merge(self, model_id, devices, loss_sum, acc_sum):
+        """ Adds reports to the pending totals of a model, without triggering a flush """
+        with self.lock:
+            totals = self.pending.setdefault(model_id, [0, 0.0, 0.0])
+            totals[0] += devices
+            totals[1] += loss_sum
+            totals[2] += acc_sum
+            self.pending_reports += devices
+
+    def __len__(self):
+        return self.pending_reports
@@ -0,0 +1,101 @@
+import os
+import time
+from flask import Response, g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess, REGISTRY,
+)
+
+# Under gunicorn every worker is its own process. Point PROMETHEUS_MULTIPROC_DIR at a directory shared by the workers
+# (and emptied on startup) to have /metrics report the whole task rather than whichever worker answered the scrape
+multiprocess_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR') or os.getenv('prometheus_multiproc_dir')
+
+REQUEST_LATENCY = Histogram(
+    'orchestration_request_seconds', 'Time spent handling requests, by route',
+    ['route', 'method', 'status'],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'orchestration_requests_in_flight', 'Requests currently being handled, by route',
+    ['route'], multiprocess_mode='livesum',
+)
+AWS_CALLS = Counter(
+    'orchestration_aws_calls_total', 'AWS API calls, by operation and the table, stack or bucket they target',
+    ['service', 'operation', 'resource', 'outcome'],
+)
+AWS_CALL_LATENCY = Histogram(
+    'orchestration_aws_call_seconds', 'Time spent on AWS API calls (including retries)',
+    ['service', 'operation', 'resource'],
+)
+PYGRID_RETRIEVE_LATENCY = Histogram(
+    'orchestration_pygrid_retrieve_seconds', 'Time spent retrieving trained models from pygrid nodes into S3',
+    ['outcome'], buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float('inf')),
+)
+
+# The parameter naming the resource an AWS call targets, by service
+RESOURCE_PARAMS = {
+    'dynamodb': 'TableName',
+    'cloudformation': 'StackName',
+    's3': 'Bucket',
+}
+
+
+def instrument_app(app):
+    """ Times every request by route, tracks requests in flight, and serves the metrics at /metrics """
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        g.metrics_started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.labels(g.metrics_route).inc()
+
+    @app.after_request
+    def observe_request(response):
+        if 'metrics_started' in g:
+            REQUEST_LATENCY.labels(g.metrics_route, request.method, response.status_code).observe(
+                time.perf_counter() - g.metrics_started)
+        return response
+
+    @app.teardown_request
+    def end_request(exc):
+        if 'metrics_started' in g:
+            REQUESTS_IN_FLIGHT.labels(g.metrics_route).dec()
+
+    @app.route("/metrics")
+    def metrics():
+        registry = REGISTRY
+        if multiprocess_dir:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def before_aws_call(event_name, params, context, **kwargs):
+    # Emitted with the call's API parameters, before they are serialized into a request
+    service = event_name.split('.')[1]
+    context['metrics_resource'] = str(params.get(RESOURCE_PARAMS.get(service), ''))
+    context['metrics_started'] = time.perf_counter()
+
+
+def after_aws_call(event_name, context, http_response, **kwargs):
+    # Error responses (e.g. failed conditional writes, throttling) are raised as ClientErrors after this event
+    observe_aws_call(event_name, context, 'success' if http_response.status_code < 300 else 'error')
+
+
+def after_aws_call_error(event_name, context, **kwargs):
+    observe_aws_call(event_name, context, 'error')
+
+
+def observe_aws_call(event_name, context, outcome):
+    if 'metrics_started' not in context:
+        return
+
+    _, service, operation = event_name.split('.', 2)
+    resource = context['metrics_resource']
+    AWS_CALLS.labels(service, operation, resource, outcome).inc()
+    AWS_CALL_LATENCY.labels(service, operation, resource).observe(time.perf_counter() - context['metrics_started'])
+
+
+def instrument_aws(aws):
+    """ Counts and times every call made through the AWS client registry """
+    aws.register('before-parameter-build', before_aws_call)
+    aws.register('after-call', after_aws_call)
+    aws.register('after-call-error', after_aws_call_error)
@@ -0,0 +1,170 @@
+import hashlib
+import tempfile
+import time
+import threading
+import zlib
+import requests
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from . import aws_clients
+from .cache_helper import SingleFlight
+from .metrics import PYGRID_RETRIEVE_LATENCY
+
+s3_bucket_name = "artificien-retrieved-models-storage"
+
+# S3 multipart parts must be at least 5 MiB (except the last one)
+PART_SIZE = 8 * 1024 * 1024
+
+# Checkpoints are stored gzipped, under the sha256 of their (uncompressed) contents
+ARTIFACT_PREFIX = 'checkpoints/'
+
+
+def retrieve_url(node_url):
+    return 'http://' + node_url + ":5000/model-centric/retrieve-model"
+
+
+def artifact_key(digest):
+    return ARTIFACT_PREFIX + digest + '.pkl.gz'
+
+
+def download_link(key, file_name, expires_in=3600):
+    """
+    A presigned URL that downloads a stored checkpoint as file_name for expires_in seconds. The checkpoint is served
+    with a gzip Content-Encoding, so browsers and http clients decompress it as they download it
+    """
+    return aws_clients.s3().generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': s3_bucket_name,
+            'Key': key,
+            'ResponseContentDisposition': 'attachment; filename="' + file_name + '"',
+        },
+        ExpiresIn=expires_in,
+    )
+
+
+class RetrievalQueue:
+    """
+    Retrieves trained models from pygrid nodes into S3 on a pool of background workers, off the request path.
+    The checkpoint is gzipped and hashed as it streams in from the node, and spooled to a temporary file, so memory use
+    doesn't grow with the model's size. If the download breaks, it is resumed where it broke. Checkpoints are stored
+    under their hash, so a checkpoint that is already stored (like an unchanged model retrieved again) isn't uploaded.
+    on_stored(model_id, key, file_name) is called once a model is stored, with the key of its checkpoint.
+    """
+
+    def __init__(self, on_stored=None, max_workers=2, attempts=5, timeout=60, compression_level=6):
+        self.on_stored = on_stored
+        self.attempts = attempts
+        self.timeout = timeout
+        self.compression_level = compression_level
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='retriever')
+        self.lock = threading.Lock()
+        self.in_flight = 0  # retrievals queued or running
+        self.failures = 0  # retrievals that failed, since the queue was created
+        self.uploads = SingleFlight()  # checkpoint key -> its upload in progress
+
+    def submit(self, user, model_id, version, node_url):
+        with self.lock:
+            self.in_flight += 1
+        return self.executor.submit(self.run, user, model_id, version, node_url)
+
+    def run(self, user, model_id, version, node_url):
+        started = time.perf_counter()
+        try:
+            key = self.retrieve(user, model_id, version, node_url)
+            PYGRID_RETRIEVE_LATENCY.labels('success').observe(time.perf_counter() - started)
+
+            if self.on_stored is not None:
+                self.on_stored(model_id, key, model_id + '-' + version + '.pkl')
+        except BaseException as exe:
+            PYGRID_RETRIEVE_LATENCY.labels('error').observe(time.perf_counter() - started)
+            print('Failed to retrieve model', model_id, exe)
+            with self.lock:
+                self.failures += 1
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def retrieve(self, user, model_id, version, node_url):
+        """ Stores a model's latest checkpoint in S3, returning its key """
+        payload = {
+            "name": model_id,
+            "version": version,
+            "checkpoint": "latest"
+        }
+
+        with tempfile.TemporaryFile() as spool:
+            digest, size = self.download(retrieve_url(node_url), payload, spool)
+            key = artifact_key(digest)
+
+            # Identical checkpoints (of any user) are only stored once, even when they are retrieved at the same time
+            self.uploads.do(key, lambda: self.store(user, model_id, key, spool, digest, size))
+        return key
+
+    def store(self, user, model_id, key, spool, digest, size):
+        """ Uploads a spooled checkpoint under key, unless it is already stored """
+        if self.is_stored(key):
+            print('Trained model', model_id, 'of', user, 'is already stored as', key)
+            return
+
+        spool.seek(0)
+        aws_clients.s3().upload_fileobj(
+            spool,
+            s3_bucket_name,
+            key,
+            ExtraArgs={
+                'ContentType': 'application/octet-stream',
+                'ContentEncoding': 'gzip',
+                'Metadata': {'sha256': digest, 'size': str(size)},
+            },
+            Config=TransferConfig(multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE, use_threads=False),
+        )
+        print('Done uploading trained model', model_id, 'of', user, 'to S3 as', key)
+
+    def is_stored(self, key):
+        try:
+            aws_clients.s3().head_object(Bucket=s3_bucket_name, Key=key)
+        except ClientError as exe:
+            # Without s3:ListBucket, S3 answers 403 rather than 404 for a missing key. Uploading it again is harmless
+            if exe.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound', '403', 'Forbidden', 'AccessDenied'):
+                return False
+            raise
+        return True
+
+    def download(self, url, payload, spool):
+        """ Writes the response body into spool gzipped, and returns the body's sha256 (in hex) and size """
+        compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip format
+        digest = hashlib.sha256()
+        received = 0  # bytes of the body that are safely in the spool
+        attempt = 0
+
+        while True:
+            # Resume from where the last attempt broke
+            headers = {'Range': 'bytes=' + str(received) + '-'} if received else {}
+            try:
+                with requests.get(url, params=payload, headers=headers, stream=True, timeout=self.timeout) as r:
+                    r.raise_for_status()
+
+                    # If the node ignored the range, skip what we already have
+                    skip = received if (received and r.status_code != 206) else 0
+
+                    for chunk in r.iter_content(chunk_size=1024 * 1024):
+                        if skip:
+                            dropped = min(skip, len(chunk))
+                            chunk = chunk[dropped:]
+                            skip -= dropped
+
+                        digest.update(chunk)
+                        spool.write(compressor.compress(chunk))
+                        received += len(chunk)
+
+                    spool.write(compressor.flush())
+                    return digest.hexdigest(), received
+
+            except requests.RequestException as exe:
+                attempt += 1
+                if attempt >= self.attempts:
+                    raise
+                print('Model download from', url, 'broke after', received, 'bytes, retrying:', exe)
+                time.sleep(min(2 ** attempt, 30))
@@ -0,0 +1,55 @@
+# Size profiles for pygrid nodes. Each profile is synthesized into a node template of its own (see AppFactory), with
+# its task size, task count limits and autoscaling targets baked in.
+#
+#   cpu, memory_limit_mib     Fargate task size (must be a valid Fargate combination)
+#   min_count, max_count      limits for autoscaling; a min_count of 0 lets an idle node scale to zero tasks
+#   cpu_target, memory_target target utilization (%) for target tracking
+#   flows_per_task            active connections per task above which the service scales out
+#   idle_minutes              minutes without a connection before a scale-to-zero node drops to zero tasks
+#   max_model_size            largest model (bytes) the profile is picked for
+#   max_devices               most training devices the profile is picked for
+PROFILES = {
+    'small': {
+        'cpu': 256, 'memory_limit_mib': 1024, 'min_count': 0, 'max_count': 2,
+        'cpu_target': 60, 'memory_target': 75, 'flows_per_task': 100, 'idle_minutes': 30,
+        'max_model_size': 10 * 1024 * 1024, 'max_devices': 100,
+    },
+    'standard': {
+        'cpu': 512, 'memory_limit_mib': 2048, 'min_count': 1, 'max_count': 4,
+        'cpu_target': 60, 'memory_target': 75, 'flows_per_task': 250, 'idle_minutes': None,
+        'max_model_size': 50 * 1024 * 1024, 'max_devices': 1000,
+    },
+    'large': {
+        'cpu': 1024, 'memory_limit_mib': 4096, 'min_count': 1, 'max_count': 10,
+        'cpu_target': 60, 'memory_target': 75, 'flows_per_task': 500, 'idle_minutes': None,
+        'max_model_size': 200 * 1024 * 1024, 'max_devices': 10000,
+    },
+    'xlarge': {
+        'cpu': 2048, 'memory_limit_mib': 8192, 'min_count': 2, 'max_count': 20,
+        'cpu_target': 60, 'memory_target': 75, 'flows_per_task': 1000, 'idle_minutes': None,
+        'max_model_size': float('inf'), 'max_devices': float('inf'),
+    },
+}
+
+# Smallest first
+PROFILE_ORDER = ['small', 'standard', 'large', 'xlarge']
+
+# Used when nothing is known about a dataset's load (and the size nodes had before profiles existed)
+DEFAULT_PROFILE = 'standard'
+
+
+def choose_profile(model_size=None, device_count=None):
+    """ Picks the smallest profile that fits a model of model_size bytes being trained by device_count devices """
+    if model_size is None and device_count is None:
+        return DEFAULT_PROFILE
+
+    for name in PROFILE_ORDER:
+        profile = PROFILES[name]
+        if (model_size or 0) <= profile['max_model_size'] and (device_count or 0) <= profile['max_devices']:
+            return name
+    return PROFILE_ORDER[-1]
+
+
+def fits_within(name, other):
+    """ Whether a node of the `other` profile is at least as big as one of profile `name` """
+    return PROFILE_ORDER.index(name) <= PROFILE_ORDER.index(other)
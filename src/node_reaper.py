@@ -0,0 +1,119 @@
+import random
+import threading
+import time
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import ClientError
+from . import aws_clients
+
+
+class NodeReaper:
+    """
+    Tears down the pygrid nodes of datasets that no longer need them: datasets whose models have all finished training
+    (and been retrieved), or that no device has reported on for idle_seconds. A background sweep looks for them every
+    interval seconds and tears down at most batch_size nodes per sweep, so a backlog of idle nodes never turns into a
+    burst of CloudFormation deletes. teardown() also serves /delete.
+
+    Nodes on shared pygrid nodes only give up their place; the shared node itself goes once its last dataset has.
+    on_teardown(dataset_id) is called for every dataset whose node was torn down.
+    """
+
+    def __init__(self, placement, stack_tracker, dataset_table='dataset_table', model_table='model_table',
+                 idle_seconds=86400, interval=900, batch_size=10, on_teardown=None):
+        self.placement = placement
+        self.stack_tracker = stack_tracker
+        self.dataset_table = dataset_table
+        self.model_table = model_table
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.batch_size = batch_size
+        self.on_teardown = on_teardown
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='node-reaper', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            # Jittered, so that the workers sharing the tables don't all sweep at once
+            time.sleep(self.interval * random.uniform(0.5, 1.5))
+            try:
+                reaped = self.sweep()
+                if reaped:
+                    print('Tore down', reaped, 'idle pygrid nodes')
+            except BaseException as exe:
+                print('Failed to sweep for idle pygrid nodes:', exe)
+
+    def sweep(self):
+        """ Tears down the nodes of up to batch_size idle datasets, and returns how many it tore down """
+        reaped = 0
+        now = int(time.time())
+        for dataset in self.datasets_with_nodes():
+            if reaped >= self.batch_size:
+                break
+            if self.is_idle(dataset, now) and self.teardown(dataset['dataset_id'], dataset.get('node_stack')):
+                reaped += 1
+        return reaped
+
+    def datasets_with_nodes(self):
+        scan_args = {
+            'FilterExpression': Attr('hasNode').eq(True),
+            'ProjectionExpression': 'dataset_id, node_stack, node_since',
+        }
+        while True:
+            response = aws_clients.table(self.dataset_table).scan(**scan_args)
+            for dataset in response['Items']:
+                yield dataset
+
+            if 'LastEvaluatedKey' not in response:
+                return
+            scan_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def is_idle(self, dataset, now):
+        models = aws_clients.table(self.model_table).query(
+            IndexName='models_dataset_index',
+            KeyConditionExpression=Key('dataset').eq(dataset['dataset_id']),
+            ProjectionExpression='percent_complete, download_link, last_report',
+        )['Items']
+
+        # Every model is trained and safely in S3
+        if models and all(model.get('percent_complete', 0) >= 100 and 'download_link' in model for model in models):
+            return True
+
+        # Nobody has trained on the node for a while. Nodes we know nothing about are left alone
+        last_active = max([model.get('last_report', 0) for model in models] + [dataset.get('node_since', 0)])
+        return last_active > 0 and now - last_active > self.idle_seconds
+
+    def teardown(self, dataset_id, stack_name=None):
+        """
+        Tears down a dataset's node, returning False if it had none, or if a provisioning job still holds the dataset's
+        lease (the job would go on to launch a node nobody tracks)
+        """
+        # Nodes launched before datasets recorded their stack are named after their dataset
+        stack_name = stack_name or dataset_id
+
+        try:
+            aws_clients.table(self.dataset_table).update_item(
+                Key={'dataset_id': dataset_id},
+                UpdateExpression='SET hasNode = :false REMOVE nodeURL, node_stack, node_since, provisioning_job',
+                ConditionExpression=Attr('hasNode').eq(True) & (
+                    Attr('provisioning_lease').not_exists() | Attr('provisioning_lease').lt(int(time.time()))),
+                ExpressionAttributeValues={':false': False},
+            )
+        except ClientError as exe:
+            if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+
+        if self.placement.owns(stack_name):
+            if self.placement.remove_tenant(stack_name, dataset_id) == 0:
+                self.placement.retire(stack_name)
+        else:
+            aws_clients.cloudformation().delete_stack(StackName=stack_name)
+            print('Deleting the node of', dataset_id, '(stack', stack_name + ')')
+
+        self.stack_tracker.forget(stack_name)
+        if self.on_teardown is not None:
+            self.on_teardown(dataset_id)
+        return True
@@ -1,22 +1,35 @@
 import os
-import boto3
+import json
+import hashlib
+import threading
 from aws_cdk import core
+from .aws_clients import cloudformation
 from .pygrid_node_stack import PygridNodeStack
+from .node_profiles import DEFAULT_PROFILE
 from .ecs_cluster_stack import EcsClusterStack
 
-client = boto3.client('cloudformation')
 env = core.Environment(account="719471536408", region="us-east-1")
 
+# The CDK app is driven through a single jsii runtime, which isn't safe to use from several threads at once
+synth_lock = threading.Lock()
+
+# Stack name used when synthesizing the shared pygrid node template
+TEMPLATE_STACK_NAME = 'pygrid-node-template'
+
 
 class AppFactory:
     location = os.path.dirname(os.path.abspath(__file__))
+    template_location = location + '/output/templates/'
+
+    # Synthesized pygrid node templates, by template version and size profile
+    templates = {}
 
     def __init__(self):
         self.app = core.App(outdir=self.location + '/output/')
         self.generated = {}
         return
 
-    def make_standard_stack(self, stack_name):
+    def make_standard_stack(self, stack_name, profile=DEFAULT_PROFILE):
 
         ecs_cluster_stack = EcsClusterStack(self.app, 'ecsCluster', env=env)
         PygridNodeStack(
@@ -26,6 +39,7 @@ class AppFactory:
             cluster=ecs_cluster_stack.cluster,
             db_url=ecs_cluster_stack.db_url,
             master_node_url=os.environ.get("MASTER_NODE_URL"),
+            profile=profile,
             env=env
         )
 
@@ -41,13 +55,75 @@ class AppFactory:
                     'Parameters': [],
                     'Capabilities': ['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'],
                 }
-                client.create_stack(**params)
+                cloudformation().create_stack(**params)
 
     def delete_stack(self):
         for stack in self.generated.stacks:
-            client.delete_stack(StackName=stack.name)
+            cloudformation().delete_stack(StackName=stack.name)
             # print(response)
 
+    @classmethod
+    def template_version(cls):
+        """ The node template only changes when the code defining the stacks does, so it is versioned by its hash """
+        digest = hashlib.sha256()
+        for file_name in ('pygrid_node_stack.py', 'ecs_cluster_stack.py', 'orchestration_helper.py', 'node_profiles.py'):
+            with open(os.path.join(cls.location, file_name), 'rb') as source:
+                digest.update(source.read())
+        return digest.hexdigest()[:16]
+
+    @classmethod
+    def has_node_template(cls, profile=DEFAULT_PROFILE):
+        version = cls.template_version() + '-' + profile
+        return version in cls.templates or os.path.exists(cls.template_location + version + '.template.json')
+
+    @classmethod
+    def node_template(cls, profile=DEFAULT_PROFILE):
+        """
+        Returns the pygrid node template body of a size profile for the current code version. It is synthesized once,
+        then served from memory or from the on-disk cache, which other workers (and the docker image build) share.
+        """
+        version = cls.template_version() + '-' + profile
+        template = cls.templates.get(version)
+        if template is not None:
+            return template
+
+        template_file = cls.template_location + version + '.template.json'
+        with synth_lock:
+            if version in cls.templates:
+                return cls.templates[version]
+
+            if os.path.exists(template_file):
+                with open(template_file) as cached:
+                    template = cached.read()
+            else:
+                app_factory = cls()
+                app_factory.make_standard_stack(TEMPLATE_STACK_NAME, profile)
+                app_factory.generate_stack()
+                template = json.dumps(app_factory.generated.get_stack_by_name(TEMPLATE_STACK_NAME).template)
+
+                # Write atomically, so that other workers never read a partial template
+                os.makedirs(cls.template_location, exist_ok=True)
+                partial_file = template_file + '.' + str(os.getpid())
+                with open(partial_file, 'w') as cached:
+                    cached.write(template)
+                os.replace(partial_file, template_file)
+
+            cls.templates[version] = template
+            return template
+
+    @classmethod
+    def launch_node(cls, stack_name, profile=DEFAULT_PROFILE):
+        """ Launches a pygrid node stack from the cached template of its profile, by substituting its parameters """
+        cloudformation().create_stack(
+            StackName=stack_name,
+            TemplateBody=cls.node_template(profile),
+            Parameters=[
+                {'ParameterKey': 'NodeId', 'ParameterValue': stack_name.lower()},
+                {'ParameterKey': 'MasterNodeUrl', 'ParameterValue': os.environ.get("MASTER_NODE_URL", '')},
+            ],
+            Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'],
+        )
+
 
 if __name__ == "__main__":
     app_factory = AppFactory()
@@ -0,0 +1,161 @@
+import time
+import uuid
+from boto3.dynamodb.conditions import Attr
+from botocore.exceptions import ClientError
+from . import aws_clients
+from .node_profiles import DEFAULT_PROFILE
+
+# Shared node states
+LAUNCHING = 'launching'
+READY = 'ready'
+
+# Shared node stacks are named pygrid-shared-<suffix>
+STACK_PREFIX = 'pygrid-shared-'
+
+
+class PlacementScheduler:
+    """
+    Packs datasets onto shared pygrid nodes instead of deploying a stack (and a load balancer) for each one. PyGrid
+    keys the training processes it hosts by model name, so the models of many datasets can share a node; devices are
+    routed to the right node through the nodeURL recorded on their dataset.
+
+    Each shared node is an item in the shared node table, with its state, address, tenant count and the datasets it
+    hosts. A dataset is placed on the least loaded node with room for it (preferring nodes that are already up), and a
+    new node is launched once every node is full. Tenants are added with conditional writes, so a node never takes
+    more than `capacity` datasets however many workers are placing them.
+    """
+
+    def __init__(self, stack_tracker, capacity=25, table_name='shared_node_table', profile=DEFAULT_PROFILE):
+        self.stack_tracker = stack_tracker
+        self.capacity = capacity
+        self.profile = profile  # the size profile of every shared node
+        self.table_name = table_name
+
+    def owns(self, stack_name):
+        return stack_name.startswith(STACK_PREFIX)
+
+    def nodes(self):
+        # One item per shared node, i.e. per `capacity` datasets, so reading them all stays cheap
+        return aws_clients.table(self.table_name).scan(ConsistentRead=True)['Items']
+
+    def candidates(self, ready_only=False):
+        """ Nodes with room for another dataset, best first: nodes that are up, then the least loaded """
+        nodes = [node for node in self.nodes() if node['tenants'] < self.capacity]
+        if ready_only:
+            nodes = [node for node in nodes if node['node_state'] == READY]
+        return sorted(nodes, key=lambda node: (node['node_state'] != READY, node['tenants']))
+
+    def place(self, dataset_id, launch=True):
+        """
+        Assigns a dataset to a shared node, returning the node's (stack_name, node_url), where node_url is None while
+        the node is still deploying. If no node has room, a new one is launched, unless launch is False, in which case
+        None is returned.
+        """
+        for node in self.candidates(ready_only=not launch):
+            placed = self.add_tenant(node['node_id'], dataset_id)
+            if placed is not None:
+                print('Placed', dataset_id, 'on shared node', node['node_id'], 'with', placed['tenants'], 'tenants')
+                return node['node_id'], placed.get('nodeURL')
+
+        if not launch:
+            return None
+        return self.launch(dataset_id), None
+
+    def add_tenant(self, stack_name, dataset_id):
+        """ Adds a dataset to a node if it still has room, returning the updated node """
+        try:
+            return aws_clients.table(self.table_name).update_item(
+                Key={'node_id': stack_name},
+                UpdateExpression='ADD tenants :one, datasets :dataset SET updated = :now',
+                ConditionExpression=Attr('node_state').exists() & Attr('tenants').lt(self.capacity),
+                ExpressionAttributeValues={':one': 1, ':dataset': {dataset_id}, ':now': int(time.time())},
+                ReturnValues='ALL_NEW',  # if the node came up meanwhile, this has its address
+            )['Attributes']
+        except ClientError as exe:
+            if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return None
+            raise
+
+    def remove_tenant(self, stack_name, dataset_id):
+        """ Frees a dataset's place on a node, returning the node's remaining tenant count """
+        try:
+            return aws_clients.table(self.table_name).update_item(
+                Key={'node_id': stack_name},
+                UpdateExpression='ADD tenants :minus_one DELETE datasets :dataset SET updated = :now',
+                ConditionExpression=Attr('datasets').contains(dataset_id),
+                ExpressionAttributeValues={':minus_one': -1, ':dataset': {dataset_id}, ':now': int(time.time())},
+                ReturnValues='UPDATED_NEW',
+            )['Attributes']['tenants']
+        except ClientError as exe:
+            if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return None
+            raise
+
+    def retire(self, stack_name):
+        """ Deletes a shared node (and its stack) once no dataset is placed on it, returning whether it did """
+        try:
+            aws_clients.table(self.table_name).delete_item(
+                Key={'node_id': stack_name},
+                ConditionExpression=Attr('tenants').eq(0),
+            )
+        except ClientError as exe:
+            if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False  # a dataset was placed on it meanwhile
+            raise
+
+        aws_clients.cloudformation().delete_stack(StackName=stack_name)
+        print('Deleting shared node', stack_name)
+        return True
+
+    def launch(self, dataset_id):
+        """ Launches a new shared node with the dataset as its first tenant, returning its stack name """
+        from .orchestration_helper import AppFactory
+
+        stack_name = STACK_PREFIX + uuid.uuid4().hex[:8]
+        aws_clients.table(self.table_name).put_item(Item={
+            'node_id': stack_name,
+            'node_state': LAUNCHING,
+            'tenants': 1,
+            'datasets': {dataset_id},
+            'updated': int(time.time()),
+        })
+
+        try:
+            AppFactory.launch_node(stack_name, self.profile)
+        except BaseException:
+            aws_clients.table(self.table_name).delete_item(Key={'node_id': stack_name})
+            raise
+
+        print('Launching shared node', stack_name, 'for', dataset_id)
+        self.stack_tracker.watch(stack_name)
+        return stack_name
+
+    def node_ready(self, stack_name, node_url):
+        """ Records a shared node's address once it has deployed, and returns the datasets placed on it """
+        try:
+            node = aws_clients.table(self.table_name).update_item(
+                Key={'node_id': stack_name},
+                UpdateExpression='SET node_state = :ready, nodeURL = :url, updated = :now',
+                ConditionExpression=Attr('node_state').exists(),
+                ExpressionAttributeValues={':ready': READY, ':url': node_url, ':now': int(time.time())},
+                ReturnValues='ALL_NEW',
+            )['Attributes']
+        except ClientError as exe:
+            if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return set()  # the node has been torn down
+            raise
+        return node.get('datasets', set())
+
+    def node_failed(self, stack_name):
+        """ Forgets a shared node that failed to deploy (and deletes its stack), and returns the datasets placed on it """
+        node = aws_clients.table(self.table_name).delete_item(
+            Key={'node_id': stack_name},
+            ReturnValues='ALL_OLD',
+        ).get('Attributes', {})
+
+        try:
+            aws_clients.cloudformation().delete_stack(StackName=stack_name)
+        except ClientError as exe:
+            print('Failed to delete the stack of shared node', stack_name, exe)
+
+        return node.get('datasets', set())
@@ -0,0 +1,258 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from . import aws_clients
+from .node_profiles import DEFAULT_PROFILE
+
+# Provisioning job states
+QUEUED = 'queued'
+SYNTHESIZING = 'synthesizing'
+LAUNCHING = 'launching'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class ProvisioningJob:
+    """ The deployment of a pygrid node for a dataset """
+
+    def __init__(self, dataset_id, job_id=None, state=QUEUED, error=None, node_url=None, profile=DEFAULT_PROFILE):
+        self.job_id = job_id or uuid.uuid4().hex
+        self.dataset_id = dataset_id
+        self.profile = profile
+        self.state = state
+        self.error = error
+        self.node_url = node_url
+        self.updated = int(time.time())
+
+    def to_dict(self):
+        job = {
+            'job_id': self.job_id,
+            'dataset_id': self.dataset_id,
+            'state': self.state,
+            'profile': self.profile,
+            'updated': self.updated,
+        }
+        if self.error is not None:
+            job['error'] = self.error
+        if self.node_url is not None:
+            job['nodeURL'] = self.node_url
+        return job
+
+    @classmethod
+    def from_dict(cls, job):
+        provisioning_job = cls(job['dataset_id'], job_id=job['job_id'], state=job['state'],
+                               error=job.get('error'), node_url=job.get('nodeURL'),
+                               profile=job.get('profile', DEFAULT_PROFILE))
+        provisioning_job.updated = int(job.get('updated', 0))
+        return provisioning_job
+
+
+class ProvisioningQueue:
+    """
+    Runs pygrid node deployments (CloudFormation launches, plus a CDK synth when no template is cached yet) on a
+    bounded pool of background workers, so that /create never blocks on them. Job state is mirrored into the
+    dataset's 'provisioning_job' attribute in the dataset table, so any worker can report on it.
+
+    Only one job per dataset runs at a time, across all workers: a job is only queued once it has taken the dataset's
+    provisioning lease, a conditional write that sets hasNode. The lease is renewed whenever the job changes state and
+    released once it is done. A lease left behind by a worker that died expires after lease_seconds, after which a new
+    job may take over (and pick up the stack its predecessor launched).
+
+    Launched stacks are handed to a StackTracker, whose callbacks should call stack_complete/stack_failed.
+    Given a PlacementScheduler, datasets are placed on shared nodes rather than each getting a stack of its own.
+    """
+
+    def __init__(self, stack_tracker, table_name='dataset_table', max_workers=2, placement=None, lease_seconds=3600):
+        self.table_name = table_name
+        self.stack_tracker = stack_tracker
+        self.placement = placement
+        self.lease_seconds = lease_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='provisioner')
+        self.lock = threading.Lock()
+        self.jobs = {}  # job_id -> ProvisioningJob
+
+    def submit(self, dataset_id, profile=DEFAULT_PROFILE):
+        """
+        Queues the deployment of a node of the given size profile for a dataset and returns its job, or None if the
+        dataset already has a node or another job is deploying one
+        """
+        job = self.acquire(dataset_id, profile)
+        if job is not None:
+            self.start(job)
+        return job
+
+    def acquire(self, dataset_id, profile=DEFAULT_PROFILE):
+        """
+        Takes the provisioning lease of a dataset without a node (setting its hasNode), returning a new job that holds
+        it, or None if the dataset has a node or another job holds the lease. The job is started with start()
+        """
+        job = ProvisioningJob(dataset_id, profile=profile)
+        try:
+            aws_clients.table(self.table_name).update_item(
+                Key={'dataset_id': dataset_id},
+                UpdateExpression='SET hasNode = :true, provisioning_job = :job, provisioning_lease = :expires',
+                ConditionExpression='attribute_not_exists(hasNode) OR hasNode = :false '
+                                    'OR (attribute_not_exists(nodeURL) AND provisioning_lease < :now)',
+                ExpressionAttributeValues={
+                    ':true': True, ':false': False, ':job': job.to_dict(), ':now': job.updated,
+                    ':expires': job.updated + self.lease_seconds,
+                },
+            )
+        except ClientError as exe:
+            if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return None
+            raise
+
+        with self.lock:
+            self.jobs[job.job_id] = job
+        return job
+
+    def start(self, job):
+        self.executor.submit(self.run, job)
+
+    def bind(self, job, stack_name, node_url):
+        """ Completes a job by binding its dataset to a node that is already up, such as a warm node """
+        job.node_url = node_url
+        job.state = READY
+        job.updated = int(time.time())
+        aws_clients.table(self.table_name).update_item(
+            Key={'dataset_id': job.dataset_id},
+            UpdateExpression='SET nodeURL = :url, node_stack = :stack, node_profile = :profile, node_since = :now, '
+                             'provisioning_job = :job REMOVE provisioning_lease',
+            ExpressionAttributeValues={
+                ':url': node_url, ':stack': stack_name, ':profile': job.profile, ':now': job.updated,
+                ':job': job.to_dict(),
+            },
+        )
+        self.done(job)
+
+    def get(self, job_id, dataset_id):
+        """ Looks a job up, first in this worker's memory and then in the dataset table """
+        job = self.find(dataset_id)
+        if job is None or job.job_id != job_id:
+            return None
+        return job
+
+    def find(self, dataset_id):
+        """ Returns the latest provisioning job of a dataset """
+        with self.lock:
+            for job in self.jobs.values():
+                if job.dataset_id == dataset_id:
+                    return job
+
+        dataset_response = aws_clients.table(self.table_name).get_item(
+            Key={'dataset_id': dataset_id},
+            ProjectionExpression='provisioning_job',
+        )
+        record = dataset_response.get('Item', {}).get('provisioning_job')
+        if record is None:
+            return None
+        return ProvisioningJob.from_dict(record)
+
+    def run(self, job):
+        try:
+            # The CDK (and its jsii/node runtime) is only loaded once a node actually needs deploying. Failing to
+            # load it fails the job, like any other error deploying the node
+            from .orchestration_helper import AppFactory
+
+            # The node template is only synthesized once per code version
+            # Shared nodes all have the placement's profile
+            if self.placement is not None:
+                job.profile = self.placement.profile
+
+            if not AppFactory.has_node_template(job.profile):
+                self.set_state(job, SYNTHESIZING)
+                AppFactory.node_template(job.profile)
+
+            self.set_state(job, LAUNCHING)
+            if self.placement is not None:
+                stack_name, node_url = self.placement.place(job.dataset_id)
+            else:
+                stack_name, node_url = job.dataset_id, None
+                # A previous node of the dataset may still be known to this worker's tracker; this is a new stack
+                self.stack_tracker.forget(stack_name)
+                try:
+                    AppFactory.launch_node(stack_name, job.profile)
+                except ClientError as exe:
+                    # Launched by a job whose lease expired before it could finish
+                    if exe.response['Error']['Code'] != 'AlreadyExistsException':
+                        raise
+                    print('Stack', stack_name, 'was already launched')
+            print('Deploying', job.dataset_id, 'on', stack_name, 'with the', job.profile, 'profile')
+
+            aws_clients.table(self.table_name).update_item(
+                Key={'dataset_id': job.dataset_id},
+                UpdateExpression='SET node_stack = :stack, node_profile = :profile',
+                ExpressionAttributeValues={':stack': stack_name, ':profile': job.profile},
+            )
+
+        except BaseException as exe:
+            print('Failed to provision a node for', job.dataset_id, exe)
+            self.fail(job, str(exe))
+            return
+
+        # Placed on a shared node that is already up
+        if node_url is not None:
+            self.stack_complete(job.dataset_id, node_url)
+            return
+
+        self.stack_tracker.watch(stack_name)
+
+    def stack_complete(self, dataset_id, node_url):
+        """ Called once a dataset's node is up. Records its address on the dataset and completes its job """
+        aws_clients.table(self.table_name).update_item(
+            Key={'dataset_id': dataset_id},
+            UpdateExpression='SET nodeURL = :url, node_since = :now REMOVE provisioning_lease',
+            ExpressionAttributeValues={':url': node_url, ':now': int(time.time())},
+        )
+
+        job = self.find(dataset_id)
+        if job is not None and job.state != READY:
+            job.node_url = node_url
+            self.set_state(job, READY)
+            self.done(job)
+
+    def stack_failed(self, dataset_id, status):
+        """ Called if a dataset's node stack failed to deploy """
+        job = self.find(dataset_id)
+        if job is not None and job.state == LAUNCHING:
+            self.fail(job, 'stack ' + status)
+
+    def fail(self, job, error):
+        job.error = error
+        self.set_state(job, FAILED)
+        self.done(job)
+
+        # Let the next /create for the dataset try again
+        aws_clients.table(self.table_name).update_item(
+            Key={'dataset_id': job.dataset_id},
+            UpdateExpression='SET hasNode = :false REMOVE provisioning_lease',
+            ExpressionAttributeValues={':false': False},
+        )
+
+    def done(self, job):
+        with self.lock:
+            self.jobs.pop(job.job_id, None)
+
+    def set_state(self, job, state):
+        job.state = state
+        job.updated = int(time.time())
+        self.record(job)
+
+    def record(self, job):
+        """ Records a job's state on its dataset, renewing its lease while it runs """
+        if job.state in (READY, FAILED):
+            aws_clients.table(self.table_name).update_item(
+                Key={'dataset_id': job.dataset_id},
+                UpdateExpression='SET provisioning_job = :job',
+                ExpressionAttributeValues={':job': job.to_dict()},
+            )
+            return
+
+        aws_clients.table(self.table_name).update_item(
+            Key={'dataset_id': job.dataset_id},
+            UpdateExpression='SET provisioning_job = :job, provisioning_lease = :expires',
+            ExpressionAttributeValues={':job': job.to_dict(), ':expires': job.updated + self.lease_seconds},
+        )
@@ -5,15 +5,24 @@ from aws_cdk import (
     aws_ecs as ecs,
     aws_elasticloadbalancingv2 as load_balancer,
     aws_ecs_patterns as ecs_patterns,
+    aws_cloudwatch as cloudwatch,
+    aws_applicationautoscaling as autoscaling,
 )
+from .node_profiles import PROFILES, DEFAULT_PROFILE
 
 
 class PygridNodeStack(cdk.Stack):
 
     def __init__(self, scope: cdk.Construct, id: str, vpc: ec2.Vpc,
-                 cluster: ecs.Cluster, db_url: str, master_node_url: str, **kwargs) -> None:
+                 cluster: ecs.Cluster, db_url: str, master_node_url: str, profile: str = DEFAULT_PROFILE,
+                 **kwargs) -> None:
 
         super().__init__(scope, id, **kwargs)
+        self.profile = PROFILES[profile]
+
+        # Per-node values are template parameters, so that one synthesized template can launch any node
+        node_id = cdk.CfnParameter(self, 'NodeId', type='String', default=id.lower())
+        master_node_url = cdk.CfnParameter(self, 'MasterNodeUrl', type='String', default=master_node_url or '')
 
         self.service = ecs_patterns.NetworkLoadBalancedFargateService(
             self, 
@@ -21,9 +30,9 @@ class PygridNodeStack(cdk.Stack):
             # Resource
 
             cluster=cluster,
-            cpu=512,
-            memory_limit_mib=2048,
-            desired_count=1,
+            cpu=self.profile['cpu'],
+            memory_limit_mib=self.profile['memory_limit_mib'],
+            desired_count=max(self.profile['min_count'], 1),  # start with a task, even if it may scale to zero
 
             # Load balancer config
             public_load_balancer=True,
@@ -35,11 +44,11 @@ class PygridNodeStack(cdk.Stack):
                 container_port=5000,
                 image=ecs.ContainerImage.from_registry('mkenney1/artificien_pygrid:latest'),
                 environment={
-                    'NODE_ID': id.lower(),  # Use stack ID as node ID
+                    'NODE_ID': node_id.value_as_string,  # Defaults to the stack ID
                     'ADDRESS': 'http://localhost:5000',
                     'PORT': '5000',
                     'DATABASE_URL': db_url,
-                    'MASTER_NODE_URL': master_node_url,
+                    'MASTER_NODE_URL': master_node_url.value_as_string,
                 },
                 enable_logging=True,
                 log_driver=ecs.AwsLogDriver(
@@ -74,5 +83,76 @@ class PygridNodeStack(cdk.Stack):
             protocol=load_balancer.Protocol.TCP
         )
         
+        self.add_autoscaling()
+
         # Get domain name of load balancer and output it to the console
         cdk.CfnOutput(self, 'PyGridNodeLoadBalancerDNS', value=self.service.load_balancer.load_balancer_dns_name)
+
+    def add_autoscaling(self):
+        """
+        Scales the service between the profile's task counts on CPU, memory, and active connections per task.
+        Profiles with a min_count of 0 also drop to zero tasks once no device has connected for idle_minutes, and
+        are woken by the first device the load balancer has to turn away.
+        """
+        profile = self.profile
+        scaling = self.service.service.auto_scale_task_count(
+            min_capacity=profile['min_count'],
+            max_capacity=profile['max_count'],
+        )
+        scaling.scale_on_cpu_utilization('CpuScaling', target_utilization_percent=profile['cpu_target'])
+        scaling.scale_on_memory_utilization('MemoryScaling', target_utilization_percent=profile['memory_target'])
+
+        # Load balancer flows are counted for the whole service, so they're divided by the running tasks (the
+        # sample count of the service's CPU utilization)
+        minute = cdk.Duration.minutes(1)
+        tasks = self.service.service.metric_cpu_utilization(statistic='SampleCount', period=minute)
+        flows = self.service.load_balancer.metric_active_flow_count(statistic='Average', period=minute)
+        flows_per_task = cloudwatch.MathExpression(
+            expression='FILL(flows, 0) / IF(FILL(tasks, 0) > 0, tasks, 1)',
+            using_metrics={'flows': flows, 'tasks': tasks},
+            period=minute,
+        )
+        scaling.scale_on_metric(
+            'ConnectionScaling',
+            metric=flows_per_task,
+            scaling_steps=[
+                autoscaling.ScalingInterval(upper=profile['flows_per_task'], change=0),
+                autoscaling.ScalingInterval(lower=profile['flows_per_task'], change=+1),
+                autoscaling.ScalingInterval(lower=profile['flows_per_task'] * 2, change=+2),
+            ],
+            cooldown=cdk.Duration.minutes(2),
+        )
+
+        if profile['min_count'] > 0:
+            return
+
+        # Scale to zero once nobody has connected for a while...
+        idle_flows = self.service.load_balancer.metric_active_flow_count(
+            statistic='Maximum', period=cdk.Duration.minutes(profile['idle_minutes']))
+        scaling.scale_on_metric(
+            'IdleScaling',
+            metric=cloudwatch.MathExpression(
+                expression='FILL(flows, 0)',
+                using_metrics={'flows': idle_flows},
+                period=cdk.Duration.minutes(profile['idle_minutes']),
+            ),
+            scaling_steps=[
+                autoscaling.ScalingInterval(upper=1, change=-profile['max_count']),
+                autoscaling.ScalingInterval(lower=1, change=0),
+            ],
+        )
+
+        # ...and back to one task as soon as the load balancer resets a connection for lack of a task
+        resets = self.service.load_balancer.metric_tcp_elb_reset_count(statistic='Sum', period=minute)
+        scaling.scale_on_metric(
+            'WakeScaling',
+            metric=cloudwatch.MathExpression(
+                expression='IF(FILL(tasks, 0) == 0, FILL(resets, 0), 0)',
+                using_metrics={'resets': resets, 'tasks': tasks},
+                period=minute,
+            ),
+            scaling_steps=[
+                autoscaling.ScalingInterval(upper=1, change=0),
+                autoscaling.ScalingInterval(lower=1, change=+1),
+            ],
+        )
@@ -1,14 +1,28 @@
 import os
-import boto3
-import requests
-import torch as th
+import math
 from decimal import Decimal
-from boto3.dynamodb.conditions import Key
-from flask import Flask, jsonify, request
-from .orchestration_helper import AppFactory
-from .cfn_helper import get_outputs
-from flask_cognito import CognitoAuth, cognito_auth_required
+from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
+from flask import Flask, Response, jsonify, request
+from . import aws_clients
+from . import metrics
+from . import repository
+from .cfn_helper import StackTracker
+from .loss_buffer import LossBuffer, add_cycle_reports
+from .cache_helper import SingleFlight, TTLCache
+from .info_encoding import InfoResponses, negotiate
+from .auth_helper import ApiKeyCache, CachedCognitoAuth, EntitlementCache, TokenCache
+from .provisioning import READY, ProvisioningQueue
+from .warm_pool import WarmPool
+from .placement import PlacementScheduler
+from .node_profiles import DEFAULT_PROFILE, choose_profile, fits_within
+from .node_reaper import NodeReaper
+from .training_history import TrainingHistory
+from .model_storage import RetrievalQueue, download_link
+from flask_cognito import cognito_auth_required, current_cognito_jwt
 import secrets
+import atexit
+import time
 
 
 app = Flask(__name__)
@@ -22,18 +36,169 @@ app.config.update({
     'COGNITO_JWT_HEADER_NAME': 'Authorization',
     'COGNITO_JWT_HEADER_PREFIX': 'Bearer',
 })
-region_name = "us-east-1"
 length = 16
-cogauth = CognitoAuth(app)
-
-
-try:
-    ecs_client = boto3.client('ecs')
-
-except BaseException as exe:
-    print(exe)
-
-dynamodb = boto3.resource('dynamodb', region_name=region_name)
+# Verified token claims are remembered until the token (or TOKEN_CACHE_SECONDS) expires
+cogauth = CachedCognitoAuth(app, token_cache=TokenCache(
+    maxsize=int(os.getenv('TOKEN_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('TOKEN_CACHE_SECONDS', '300')),
+))
+
+# Per-route request and per-operation AWS call metrics, served at /metrics
+metrics.instrument_app(app)
+metrics.instrument_aws(aws_clients.aws)
+
+# Aggregates batched loss reports per model before they're written to the model table
+loss_buffer = LossBuffer(
+    'model_table',
+    max_reports=int(os.getenv('LOSS_BUFFER_MAX_REPORTS', '500')),
+    flush_interval=float(os.getenv('LOSS_BUFFER_FLUSH_SECONDS', '1.0')),
+)
+atexit.register(loss_buffer.flush)
+
+# Each dataset's list of models that are still training, as served by /info
+trainable_models_cache = TTLCache(
+    maxsize=int(os.getenv('INFO_CACHE_MAX_DATASETS', '4096')),
+    ttl=float(os.getenv('INFO_CACHE_SECONDS', '30')),
+)
+
+# Each dataset's last /info response, with its version tag (ETag) and its bodies as encoded for the devices polling it.
+# Devices polling with a current tag are answered without any lookups, and the rest without re-encoding the response
+info_responses = InfoResponses(
+    maxsize=int(os.getenv('INFO_CACHE_MAX_DATASETS', '4096')),
+    ttl=float(os.getenv('INFO_CACHE_SECONDS', '30')),
+)
+
+# How long devices are told to wait before polling /info again
+INFO_POLL_SECONDS = int(os.getenv('INFO_POLL_SECONDS', '30'))
+
+
+def dataset_changed(dataset_id):
+    """ Drops what this worker has cached about a dataset's models and node, after either changed """
+    trainable_models_cache.invalidate(dataset_id)
+    info_responses.invalidate(dataset_id)
+
+
+# Results of verifying device api keys against datasets. /generate_key only drops them in the worker that handles it,
+# so other workers keep accepting a replaced key for up to API_KEY_CACHE_SECONDS: keep it short
+api_key_cache = ApiKeyCache(
+    maxsize=int(os.getenv('API_KEY_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('API_KEY_CACHE_SECONDS', '30')),
+    negative_ttl=float(os.getenv('API_KEY_NEGATIVE_CACHE_SECONDS', '30')),
+)
+
+
+def node_deployed(stack_name, outputs):
+    """ Records a newly deployed node's address, so that later /create calls never need to ask CloudFormation """
+    node_url = outputs.get('PyGridNodeLoadBalancerDNS')
+    if node_url is None:
+        print('Cloudformation Outputs for the', stack_name, 'stack are not properly configured')
+        return
+
+    if warm_pool.owns(stack_name):
+        warm_pool.node_ready(stack_name, node_url)
+        return
+
+    # A shared node serves every dataset placed on it while it deployed; any other node is named after its dataset
+    if placement.owns(stack_name):
+        for dataset_id in placement.node_ready(stack_name, node_url):
+            provisioning_queue.stack_complete(dataset_id, node_url)
+        return
+
+    provisioning_queue.stack_complete(stack_name, node_url)
+
+    # Its address is on the dataset now. Not keeping the outputs means that, once the node is torn down, no worker
+    # can mistake them for those of the dataset's next node
+    stack_tracker.forget(stack_name)
+
+
+def node_failed(stack_name, status):
+    if warm_pool.owns(stack_name):
+        warm_pool.node_failed(stack_name, status)
+        return
+
+    dataset_ids = placement.node_failed(stack_name) if placement.owns(stack_name) else [stack_name]
+    for dataset_id in dataset_ids:
+        provisioning_queue.stack_failed(dataset_id, status)
+
+
+# Polls the stacks of deploying nodes from one background loop
+stack_tracker = StackTracker(
+    on_complete=node_deployed,
+    on_failed=node_failed,
+    poll_interval=float(os.getenv('STACK_POLL_SECONDS', '10')),
+    max_interval=float(os.getenv('STACK_POLL_MAX_SECONDS', '300')),
+)
+
+
+# How long the download links of retrieved models work for
+DOWNLOAD_LINK_SECONDS = int(os.getenv('DOWNLOAD_LINK_SECONDS', '3600'))
+
+
+def model_stored(model_id, key, file_name):
+    """ Records where a retrieved model is stored on its DB entry, with a link to download it """
+    repository.models.update(model_id, {
+        'artifact_key': key,
+        'artifact_name': file_name,
+        'download_link': download_link(key, file_name, DOWNLOAD_LINK_SECONDS),
+        'download_link_expires': int(time.time()) + DOWNLOAD_LINK_SECONDS,
+    })
+    print("UPDATE success")
+
+
+# Streams trained models from pygrid nodes to S3 in the background
+retrieval_queue = RetrievalQueue(
+    on_stored=model_stored,
+    max_workers=int(os.getenv('RETRIEVAL_WORKERS', '2')),
+    compression_level=int(os.getenv('MODEL_COMPRESSION_LEVEL', '6')),
+)
+
+# With PLACEMENT_MODE=shared, datasets are packed onto shared pygrid nodes rather than each getting its own
+shared_placement = os.getenv('PLACEMENT_MODE', 'dedicated') == 'shared'
+placement = PlacementScheduler(
+    stack_tracker,
+    capacity=int(os.getenv('SHARED_NODE_CAPACITY', '25')),
+    table_name='shared_node_table',
+    profile=os.getenv('SHARED_NODE_PROFILE', 'large'),
+)
+
+# Deploys new pygrid nodes in the background, off the request thread
+provisioning_queue = ProvisioningQueue(
+    stack_tracker,
+    'dataset_table',
+    max_workers=int(os.getenv('PROVISIONING_WORKERS', '2')),
+    placement=placement if shared_placement else None,
+    lease_seconds=int(os.getenv('PROVISIONING_LEASE_SECONDS', '3600')),
+)
+
+# Concurrent /create calls of this worker, by dataset
+create_flights = SingleFlight()
+
+# Deployed nodes waiting to be handed to new datasets (none unless WARM_POOL_SIZE is set)
+warm_pool = WarmPool(
+    stack_tracker,
+    size=int(os.getenv('WARM_POOL_SIZE', '0')),
+    table_name='node_pool_table',
+    refill_interval=float(os.getenv('WARM_POOL_REFILL_SECONDS', '300')),
+)
+warm_pool.start()
+
+# Loss, accuracy and device count of every finished training cycle, in per-model time buckets
+training_history = TrainingHistory(
+    'model_metrics_table',
+    bucket_seconds=int(os.getenv('METRICS_BUCKET_SECONDS', '86400')),
+)
+
+# Tears down the nodes of datasets whose models are all done, or that have gone idle (only if NODE_REAPER=True)
+node_reaper = NodeReaper(
+    placement,
+    stack_tracker,
+    idle_seconds=float(os.getenv('NODE_IDLE_SECONDS', '86400')),
+    interval=float(os.getenv('NODE_REAPER_INTERVAL_SECONDS', '900')),
+    batch_size=int(os.getenv('NODE_REAPER_BATCH_SIZE', '10')),
+    on_teardown=dataset_changed,
+)
+if os.getenv('NODE_REAPER', 'False') == 'True':
+    node_reaper.start()
 
 
 # check api status, ping to test
@@ -46,9 +211,7 @@ def status():
 @app.route("/create", methods=["POST"])
 @cognito_auth_required
 def create_node():
-    # grab model id, query model_table to check if a node has already been spun up for model
-    model_table = dynamodb.Table('model_table')
-    dataset_table = dynamodb.Table('dataset_table')
+    # grab model id, check the model and whether a node has already been spun up for its dataset
     model_id = request.json.get('model_id')
     dataset_id = request.json.get('dataset_id')
     features = request.json.get('features')
@@ -56,73 +219,177 @@ def create_node():
 
     model_id = model_id.lower()
 
+    # the size of the model in bytes, if the client knows it, is used to size the dataset's node
+    model_size = request.json.get('model_size')
+    if model_size is not None and (type(model_size) is not int or model_size < 0):
+        return jsonify({'error': 'model_size must be a number of bytes'}), 400
+
+    # The model and dataset are independent lookups, so they are made concurrently
     try:
-        model_response = model_table.query(KeyConditionExpression=Key('model_id').eq(model_id))
+        model, dataset = aws_clients.fan_out(
+            lambda: repository.models.get(model_id, ['owner_name']),
+            lambda: repository.datasets.get(dataset_id, ['hasNode', 'nodeURL', 'node_stack', 'num_devices']),
+        )
     except:
         return jsonify({'error': 'failed to query dynamodb'}), 500
 
-    if model_response['Items'] is None:
+    if model is None:
         return jsonify({'error': 'model id not found'}), 400
 
-    try:
-        dataset_response = dataset_table.query(KeyConditionExpression=Key('dataset_id').eq(dataset_id))
-    except:
-        return jsonify({'error': 'failed to query dynamodb'}), 500
-
-    if dataset_response['Items'] is None:
+    if dataset is None:
         return jsonify({'error': 'dataset_id not found'}), 400
 
     # first validate the user has access to data requested
-    owner = model_response['Items'][0]['owner_name']
+    owner = model['owner_name']
     if validate_user(dataset_id, owner) is False:
         return jsonify({'error': 'user has not purchased requested dataset'}), 600
 
-    # next, record model features and labels in the database
-    model_response['Items'][0]['features'] = features
-    model_response['Items'][0]['labels'] = labels
-    model_table.put_item(Item=model_response['Items'][0])
-    
+    # Concurrent /create calls for a dataset (like one per model of a batch) share one provisioning of its node
+    try:
+        node = create_flights.do(dataset_id, lambda: provide_node(dataset_id, dataset, model_size))
+    except:
+        return jsonify({'error': 'failed to provision a node'}), 500
+
+    # next, record model features and labels (and the node's address, once it has one) in the database
+    model_fields = {'features': features, 'labels': labels}
+    if node.get('nodeURL') is not None:
+        model_fields['node_URL'] = node['nodeURL']
+    repository.models.update(model_id, model_fields)
+    dataset_changed(dataset_id)
+
+    return jsonify(node)
+
+
+def provide_node(dataset_id, dataset, model_size=None):
+    """
+    Makes sure a dataset has a node, deployed or on its way, and returns the /create response about it. Of all the
+    calls for a dataset, in any worker, only the one that takes its provisioning lease provides the node
+    """
     # if dataset hasNode, check if node is fully deployed
-    if dataset_response['Items'][0]['hasNode'] is True:
-        output_dict = get_outputs(stack_name=dataset_id)
+    if dataset.get('hasNode') is True:
+        return node_status(dataset_id, dataset.get('nodeURL'), dataset.get('node_stack'))
+
+    # size the node for the model (its size in bytes, if the client knows it) and the devices the dataset has
+    profile = placement.profile if shared_placement else choose_profile(model_size, dataset.get('num_devices'))
+
+    # take the dataset's provisioning lease (setting hasNode), unless another call has just done so
+    job = provisioning_queue.acquire(dataset_id, profile)
+    if job is None:
+        return node_status(dataset_id)
 
-        # If we are on a 'LOCALTEST', then the pygrid node won't get picked up by cloudformation
-        # (since pygrid is simply running on local)
-        if os.getenv('LOCALTEST') == 'True':
-            nodeURL = dataset_response['Items'][0]['nodeURL']
+    # bind the dataset to a node that is already up: a place on a shared node, or a warm node
+    try:
+        if shared_placement:
+            ready_node = placement.place(dataset_id, launch=False)
         else:
-            if output_dict is None:
-                return jsonify({'status': 'node is deploying, please wait'})
+            # Warm nodes have the default profile, so they also serve datasets that would fit a smaller one
+            ready_node = warm_pool.claim(dataset_id) if fits_within(profile, DEFAULT_PROFILE) else None
+            if ready_node is not None:
+                job.profile = DEFAULT_PROFILE
+    except:
+        ready_node = None
+
+    if ready_node is not None:
+        stack_name, nodeURL = ready_node
+        try:
+            provisioning_queue.bind(job, stack_name, nodeURL)
+        except:
+            provisioning_queue.fail(job, 'failed to bind node ' + stack_name)
+            raise
+        return {'status': 'ready', 'nodeURL': nodeURL}
+
+    # otherwise queue the deployment of its resources
+    provisioning_queue.start(job)
+    print("Queued deployment", job.job_id)
+
+    return {'status': 'node is starting to deploy. This may take a few minutes', 'job_id': job.job_id}
+
+
+def node_status(dataset_id, nodeURL=None, node_stack=None):
+    """
+    The /create response about a dataset's node, which is either deployed (at nodeURL, if known) or deploying (as
+    node_stack, if known)
+    """
+    # Once a node is deployed its address is recorded on the dataset, so CloudFormation is only involved until then.
+    # (If we are on a 'LOCALTEST', the pygrid node is simply running on local and is always recorded)
+    # Nodes of their own are named after their dataset. Shared nodes record their address on every dataset placed on
+    # them once they are up, so their stacks are left to the placement
+    stack_name = node_stack or (None if shared_placement else dataset_id)
+    job = None
+    if nodeURL is None and stack_name is not None and not placement.owns(stack_name):
+        output_dict = stack_tracker.outputs(stack_name)
+        if output_dict is not None:
             nodeURL = output_dict['PyGridNodeLoadBalancerDNS']
+            repository.datasets.update(dataset_id, {'nodeURL': nodeURL})
+            stack_tracker.forget(stack_name)
+
+    if nodeURL is None:
+        job = provisioning_queue.find(dataset_id)
+        if job is not None and job.state == READY:
+            nodeURL = job.node_url
+
+    if nodeURL is None:
+        status = {'status': 'node is deploying, please wait'}
+        if job is not None:
+            status['job_id'] = job.job_id
+        return status
 
-        # put nodeAddress into DB
-        model_response['Items'][0]['node_URL'] = nodeURL
-        model_table.put_item(Item=model_response['Items'][0])
+    print(nodeURL)
+    return {'status': 'ready', 'nodeURL': nodeURL}
 
-        dataset_response['Items'][0]['nodeURL'] = nodeURL
-        dataset_table.put_item(Item=dataset_response['Items'][0])
-        print(nodeURL)
-        return jsonify({'status': 'ready', 'nodeURL': nodeURL})
 
-    # if dataset doesn't have node, deploy resources
-    app_factory = AppFactory()
-    app_factory.make_standard_stack(dataset_id)
-    app_factory.generate_stack()
-    app_factory.launch_stack()
-    print("Deploying")
+@app.route("/create_status", methods=["POST"])
+@cognito_auth_required
+def create_status():
+    """ Reports the state of a node deployment queued by /create: queued, synthesizing, launching, ready or failed """
+    job_id = request.json.get('job_id')
+    dataset_id = request.json.get('dataset_id')
+
+    try:
+        job = provisioning_queue.get(job_id, dataset_id)
+    except:
+        return jsonify({'error': 'failed to query dynamodb'}), 500
 
-    # set hasNode to true
-    dataset_response['Items'][0]['hasNode'] = True
-    dataset_table.put_item(Item=dataset_response['Items'][0])
+    if job is None:
+        return jsonify({'error': 'provisioning job not found'}), 400
 
-    return jsonify({'status': 'node is starting to deploy. This may take a few minutes'})
+    return jsonify(job.to_dict())
 
 
 # delete node of an app developer
 @app.route("/delete", methods=["POST"])
 @cognito_auth_required
 def delete_node():
-    return None
+    """ Tears down a dataset's node. Only the dataset's owner can """
+    dataset_id = request.json.get('dataset_id')
+
+    try:
+        dataset = repository.datasets.get(dataset_id, ['owner_username', 'hasNode', 'node_stack', 'provisioning_lease'])
+    except:
+        return jsonify({'error': 'failed to query dynamodb'}), 500
+
+    if dataset is None:
+        return jsonify({'error': 'dataset_id not found'}), 400
+
+    username = current_cognito_jwt.get('username') or current_cognito_jwt.get('cognito:username')
+    if dataset.get('owner_username') != username:
+        return jsonify({'error': 'user does not own requested dataset'}), 403
+
+    if dataset.get('hasNode') is not True:
+        return jsonify({'status': 'dataset has no node'})
+
+    # A node that is still being provisioned can only be deleted once it is up (or has failed)
+    if dataset.get('provisioning_lease', 0) >= time.time():
+        return jsonify({'error': 'node is still deploying, delete it once it is ready'}), 409
+
+    try:
+        if not node_reaper.teardown(dataset_id, dataset.get('node_stack')):
+            return jsonify({'error': 'node is being deployed or deleted by another request, try again later'}), 409
+    except:
+        return jsonify({'error': 'failed to delete node'}), 500
+
+    return jsonify({'status': 'node is being deleted'})
+
 
 @app.route("/model_loss", methods=["POST"])
 def model_loss():
@@ -130,35 +397,88 @@ def model_loss():
     Receives reports of model loss and updates the DB accordingly.
     Model loss is updated on a cycle-by-cycle basis. So... each time a cycle
     completes, the loss is reset.
+
+    The running loss/acc sums and the device count are atomic counters, so each report is a single
+    UpdateItem and concurrent reports never overwrite each other. Averages are derived on read.
     """
-    acc = float(request.json.get('acc'))
-    loss = float(request.json.get('loss'))
+    try:
+        acc = float(request.json.get('acc'))
+        loss = float(request.json.get('loss'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'loss and acc must be numbers'}), 400
+    if not (math.isfinite(loss) and math.isfinite(acc)):
+        return jsonify({'error': 'loss and acc must be finite'}), 400
     model_id = request.json.get('model_id')
-    model_table = dynamodb.Table('model_table')
+    model_table = aws_clients.table('model_table')
 
     # Debugging
     print('Model', model_id, 'had a loss of', loss)
 
-    # Update the DynamoDB entry for the model
+    # Add the report to the running sums of the cycle
     try:
-        model_response = model_table.query(KeyConditionExpression=Key('model_id').eq(model_id))
-        model = model_response['Items'][0]
-    except:
-        return jsonify({'error': 'failed to query dynamodb'}), 500
-
-    # Determine the new average model loss across the cycle
-    loss_sum = float(model['devices_trained_this_cycle'] * model['loss_this_cycle'])
-    acc_sum = float(model['devices_trained_this_cycle'] * model['acc_this_cycle'])
-    new_loss = (loss_sum + loss) / float(model['devices_trained_this_cycle'] + 1)
-    new_acc = (acc_sum + acc) / float(model['devices_trained_this_cycle'] + 1)
-
-    # Update the model loss
-    model['devices_trained_this_cycle'] += 1
-    model['loss_this_cycle'] = Decimal(new_loss)
-    model['acc_this_cycle'] = Decimal(new_acc)
-    model_table.put_item(Item=model)
-
-    return jsonify({'status': 'model loss/acc was updated successfully'})
+        update_response = add_cycle_reports(model_table, model_id, 1, loss, acc, return_values='UPDATED_NEW')
+    except ClientError as exe:
+        if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return jsonify({'error': 'model id not found'}), 400
+        return jsonify({'error': 'failed to update dynamodb'}), 500
+
+    loss_this_cycle, acc_this_cycle = cycle_averages(update_response['Attributes'])
+    return jsonify({
+        'status': 'model loss/acc was updated successfully',
+        'loss_this_cycle': loss_this_cycle,
+        'acc_this_cycle': acc_this_cycle,
+    })
+
+
+@app.route("/model_loss_batch", methods=["POST"])
+def model_loss_batch():
+    """
+    Receives many loss/acc reports at once, as a list of {model_id, loss, acc} under 'reports'.
+    Reports are combined per model and buffered, so they are written to the DB with one update per model.
+    """
+    reports = request.json.get('reports')
+    if not isinstance(reports, list):
+        return jsonify({'error': 'reports must be a list of {model_id, loss, acc}'}), 400
+
+    # Combine the reports per model before handing them to the buffer
+    totals = {}
+    rejected = 0
+    for report in reports:
+        try:
+            model_id = report['model_id']
+            loss = float(report['loss'])
+            acc = float(report['acc'])
+        except (KeyError, TypeError, ValueError):
+            rejected += 1
+            continue
+        if not (isinstance(model_id, str) and model_id and math.isfinite(loss) and math.isfinite(acc)):
+            rejected += 1
+            continue
+
+        model_totals = totals.setdefault(model_id, [0, 0.0, 0.0])
+        model_totals[0] += 1
+        model_totals[1] += loss
+        model_totals[2] += acc
+
+    for model_id, (devices, loss_sum, acc_sum) in totals.items():
+        loss_buffer.add(model_id, loss_sum, acc_sum, devices=devices)
+
+    return jsonify({
+        'status': 'model loss/acc reports were accepted',
+        'accepted': len(reports) - rejected,
+        'rejected': rejected,
+    })
+
+
+def cycle_averages(model):
+    """ Derives the average loss and accuracy of the current cycle from a model's running sums """
+    devices = model.get('devices_trained_this_cycle', 0)
+    if not devices:
+        return None, None
+
+    loss_sum = model.get('loss_sum_this_cycle', 0)
+    acc_sum = model.get('acc_sum_this_cycle', 0)
+    return float(loss_sum) / float(devices), float(acc_sum) / float(devices)
 
 
 @app.route("/model_progress", methods=["POST"])
@@ -168,82 +488,269 @@ def model_progress():
     # Get the new model complete metric from PyGrid
     model_id = request.json.get('model_id')
     percent_complete = request.json.get('percent_complete')
-    model_table = dynamodb.Table('model_table')
+    model_table = aws_clients.table('model_table')
 
     # Debugging
     print('Got model', model_id, 'from PyGrid, which is', percent_complete, 'percent complete')
 
-    # Update the DynamoDB entry for 'percent_complete'
+    # Write the reports this process still buffers for the model, so that they count towards the cycle that just ended
+    loss_buffer.flush_model(model_id)
+
+    # Set the new completion percentage and, now that the cycle is complete, reset the cycle counters.
+    # This is a single UpdateItem so that it can't clobber loss reports arriving at the same time
     try:
-        model_response = model_table.query(KeyConditionExpression=Key('model_id').eq(model_id))
-        model = model_response['Items'][0]
+        update_response = model_table.update_item(
+            Key={'model_id': model_id},
+            UpdateExpression='SET percent_complete = :p, devices_trained_this_cycle = :zero, '
+                             'loss_sum_this_cycle = :zero, acc_sum_this_cycle = :zero, last_report = :now',
+            ConditionExpression=Attr('model_id').exists(),
+            ExpressionAttributeValues={
+                ':p': Decimal(str(percent_complete)),
+                ':zero': 0,
+                ':now': int(time.time()),
+            },
+            ReturnValues='ALL_OLD',
+        )
+        model = update_response['Attributes']
+    except ClientError as exe:
+        if exe.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return jsonify({'error': 'model id not found'}), 400
+        return jsonify({'error': 'failed to update dynamodb'}), 500
     except:
-        return jsonify({'error': 'failed to query dynamodb'}), 500
-
-    # Set the new completion percentage
-    model['percent_complete'] = Decimal(percent_complete)
+        return jsonify({'error': 'failed to update dynamodb'}), 500
 
-    # Now that the cycle is complete, reset num_devices trained
-    model['devices_trained_this_cycle'] = 0
+    dataset_changed(model.get('dataset'))
 
-    model_table.put_item(Item=model)
+    # Keep the aggregates of the cycle that just finished (its counters were reset above)
+    loss_this_cycle, acc_this_cycle = cycle_averages(model)
+    if loss_this_cycle is not None:
+        try:
+            training_history.record(model_id, loss_this_cycle, acc_this_cycle, model['devices_trained_this_cycle'])
+        except BaseException as exe:
+            print('Failed to record the finished cycle of', model_id, exe)
 
     # If the model is done training, retrieve it so that the user can download it
     if percent_complete == 100:
-        # Do model retrieval
+        # Do model retrieval, in the background so that pygrid isn't kept waiting on large models
         try:
-            retrieve(user=model['owner_name'], model_id=model_id, version=model['version'], node_url=model['node_URL'])
+            retrieval_queue.submit(user=model['owner_name'], model_id=model_id, version=model['version'],
+                                   node_url=model['node_URL'])
         except:
             return jsonify({'error': 'failed to perform model retrieval'}), 500
 
-        # If all models left in the node are done, spin it down
+        # Once all models left in the node are done (and retrieved), the node reaper spins it down
 
     return jsonify({'status': 'model progress was updated successfully'})
 
 
+@app.route("/download_link", methods=["POST"])
+@cognito_auth_required
+def get_download_link():
+    """ Returns a fresh link to download a retrieved model, for its owner. Links expire after DOWNLOAD_LINK_SECONDS """
+    model_id = request.json.get('model_id')
+
+    try:
+        model = repository.models.get(model_id, ['owner_name', 'artifact_key', 'artifact_name'])
+    except:
+        return jsonify({'error': 'failed to query dynamodb'}), 500
+
+    if model is None:
+        return jsonify({'error': 'model id not found'}), 400
+
+    username = current_cognito_jwt.get('username') or current_cognito_jwt.get('cognito:username')
+    if model.get('owner_name') != username:
+        return jsonify({'error': 'user does not own requested model'}), 403
+
+    if 'artifact_key' not in model:
+        return jsonify({'error': 'model has not been retrieved yet'}), 400
+
+    return jsonify({
+        'download_link': download_link(model['artifact_key'], model['artifact_name'], DOWNLOAD_LINK_SECONDS),
+        'expires': int(time.time()) + DOWNLOAD_LINK_SECONDS,
+    })
+
+
+def as_int(value):
+    """ A request parameter as an int, or None if it isn't a number (booleans aren't) """
+    if isinstance(value, bool):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+@app.route("/model_metrics", methods=["POST"])
+@cognito_auth_required
+def model_metrics():
+    """
+    Returns a model's loss, accuracy and device count per finished training cycle, optionally between since and until
+    (unix times) and averaged down to at most `points` points, along with those of the cycle in progress so far
+    """
+    model_id = request.json.get('model_id')
+    since = request.json.get('since')
+    until = request.json.get('until')
+    points = request.json.get('points')
+
+    if not isinstance(model_id, str) or not model_id:
+        return jsonify({'error': 'model_id must be given'}), 400
+
+    if since is not None:
+        since = as_int(since)
+        if since is None:
+            return jsonify({'error': 'since must be a unix time'}), 400
+
+    if until is not None:
+        until = as_int(until)
+        if until is None:
+            return jsonify({'error': 'until must be a unix time'}), 400
+
+    if points is not None:
+        points = as_int(points)
+        if points is None or points <= 0:
+            return jsonify({'error': 'points must be a positive integer'}), 400
+
+    # The finished cycles and the running sums of the current one are independent lookups, made concurrently
+    try:
+        curves, model = aws_clients.fan_out(
+            lambda: training_history.curves(model_id, since=since, until=until, points=points),
+            lambda: repository.models.get(
+                model_id, ['devices_trained_this_cycle', 'loss_sum_this_cycle', 'acc_sum_this_cycle']),
+        )
+    except:
+        return jsonify({'error': 'failed to query dynamodb'}), 500
+
+    curves['model_id'] = model_id
+    curves['points'] = len(curves['t'])
+
+    current_cycle = None
+    if model is not None:
+        loss_this_cycle, acc_this_cycle = cycle_averages(model)
+        current_cycle = {
+            'loss': loss_this_cycle,
+            'acc': acc_this_cycle,
+            'devices': int(model.get('devices_trained_this_cycle', 0)),
+        }
+    curves['current_cycle'] = current_cycle
+    return jsonify(curves)
+
+
 @app.route("/info", methods=["POST"])
 def get_info():
-    # validate api key
+    """
+    Serves devices the models they can train on a dataset, and its node. Responses carry an ETag: a device that sends
+    it back in If-None-Match gets a bodyless 304 while nothing changed. X-Poll-Interval says when to poll again.
+
+    Responses are JSON, or MessagePack for devices that accept application/msgpack, and compressed with zstd or gzip
+    for devices that accept either (Accept-Encoding).
+    """
     api_key = request.headers.get('api_key')
     dataset_id = request.json.get('dataset_id')
-    resp = validate_api_key(api_key, dataset_id)
-    if resp is not True:
+    media_type, coding = negotiate(request)
+
+    # Keys we already know to be wrong are turned away without touching DynamoDB
+    if not api_key or api_key_cache.get(dataset_id, api_key) is False:
         return jsonify({'error': 'cannot authenticate, verify provided api_key'}), 400
 
-    dataset_table = dynamodb.Table('dataset_table')
-    model_table = dynamodb.Table('model_table')
+    # Devices whose copy is still current are answered from memory, if we know their key is right
+    version = info_responses.current(dataset_id)
+    if version is not None and request.if_none_match.contains(version.etag_of(media_type, coding)) \
+            and api_key_cache.get(dataset_id, api_key):
+        return not_modified(version.etag_of(media_type, coding))
 
+    # The dataset and its models are independent lookups, so they are made concurrently once the key is known to be
+    # right. Until then only the lookups needed to check it are made, so unknown keys never cost (or cache) models
+    dataset_fields = ['owner_username', 'properlySetUp', 'hasNode', 'nodeURL']
+    rmodels = None
     try:
-        dataset_response = dataset_table.query(KeyConditionExpression=Key('dataset_id').eq(dataset_id))
+        if api_key_cache.get(dataset_id, api_key):
+            dataset, rmodels = aws_clients.fan_out(
+                lambda: repository.datasets.get(dataset_id, dataset_fields),
+                lambda: get_trainable_models(dataset_id),
+            )
+        else:
+            dataset = repository.datasets.get(dataset_id, dataset_fields)
     except:
         return jsonify({'error': 'failed to query dynamodb'}), 400
 
-    if not dataset_response['Items'][0]['properlySetUp']:
-        dataset_response['Items'][0]['properlySetUp'] = True
-        dataset_table.put_item(Item=dataset_response['Items'][0])
+    if dataset is None:
+        api_key_cache.set(dataset_id, api_key, None, False)
+        return jsonify({'error': 'cannot authenticate, verify provided api_key'}), 400
+
+    # validate api key, against the owner of the dataset we already have
+    resp = validate_api_key(api_key, dataset_id, dataset)
+    if resp is not True:
+        return jsonify({'error': 'cannot authenticate, verify provided api_key'}), 400
+
+    if not dataset['properlySetUp']:
+        repository.datasets.update(dataset_id, {'properlySetUp': True})
         return jsonify({'success': dataset_id+' is properly configured'})
 
-    if not dataset_response['Items'][0]['hasNode']:
+    if not dataset['hasNode']:
         return jsonify({'wait': 'no node available yet'})
 
-    node_url = dataset_response['Items'][0]['nodeURL']
+    if rmodels is None:
+        try:
+            rmodels = get_trainable_models(dataset_id)
+        except:
+            return jsonify({'error': 'failed to query dynamodb'}), 400
 
-    try:
-        model_response = model_table.scan(FilterExpression=Key('dataset').eq(dataset_id), ProjectionExpression='model_id, version, features, labels, percent_complete')
-    except:
-        return jsonify({'error': 'failed to query dynamodb'}), 400
+    # Encoded once per version of the response and encoding
+    version = info_responses.version(dataset_id, rmodels, dataset['nodeURL'])
+    etag, body = version.representation(media_type, coding)
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
 
-    models = model_response['Items']
-    rmodels = []
+    response = Response(body, mimetype=media_type)
+    if coding is not None:
+        response.headers['Content-Encoding'] = coding
+    response.set_etag(etag)
+    return poll_hint(response)
 
-    for model in models:
-        try:
-            if model['percent_complete'] != 100:
+
+def not_modified(etag):
+    response = Response(status=304)
+    response.set_etag(etag)
+    return poll_hint(response)
+
+
+def poll_hint(response):
+    response.vary.update(('Accept', 'Accept-Encoding'))
+    response.headers['Cache-Control'] = 'private, max-age=' + str(INFO_POLL_SECONDS)
+    response.headers['X-Poll-Interval'] = str(INFO_POLL_SECONDS)
+    return response
+
+
+def get_trainable_models(dataset_id):
+    """
+    Lists the (model_id, version, features, labels) of every model on a dataset that hasn't finished training.
+    Served from the models_dataset_index, and cached per dataset until a model on it changes.
+    """
+    rmodels = trainable_models_cache.get(dataset_id)
+    if rmodels is not None:
+        return rmodels
+
+    model_table = aws_clients.table('model_table')
+    query_args = {
+        'IndexName': 'models_dataset_index',
+        'KeyConditionExpression': Key('dataset').eq(dataset_id),
+        'ProjectionExpression': 'model_id, version, features, labels, percent_complete',
+    }
+
+    rmodels = []
+    while True:
+        model_response = model_table.query(**query_args)
+        for model in model_response['Items']:
+            if model.get('percent_complete') != 100:
                 rmodels.append((model['model_id'], model['version'], model['features'], model['labels']))
-        except:
-            rmodels.append((model['model_id'], model['version'], model['features'], model['labels']))
 
-    return jsonify({'models': rmodels, 'nodeURL': node_url})
+        # Results are paginated past 1 MB
+        if 'LastEvaluatedKey' not in model_response:
+            break
+        query_args['ExclusiveStartKey'] = model_response['LastEvaluatedKey']
+
+    trainable_models_cache.set(dataset_id, rmodels)
+    return rmodels
 
 
 @app.route("/generate_key", methods=["POST"])
@@ -251,18 +758,19 @@ def get_info():
 def generate_key():
     user_id = request.json.get('user_id')
     api_key = secrets.token_urlsafe(length)
-    user_table = dynamodb.Table('user_table')
 
     try:
-        user_response = user_table.query(KeyConditionExpression=Key('user_id').eq(user_id))
+        user = repository.users.get(user_id, ['username'])
     except:
         return jsonify({'error': 'failed to query dynamodb'}), 500
 
-    if user_response['Items'] is None:
+    if user is None:
         return jsonify({'error': 'user not found'}), 400
 
-    user_response['Items'][0]['api_key'] = api_key
-    user_table.put_item(Item=user_response['Items'][0])
+    repository.users.update(user_id, {'api_key': api_key})
+
+    # Previously verified keys for this user's datasets are no longer valid
+    api_key_cache.invalidate_owner(user.get('username'))
 
     return jsonify({'api_key': api_key})
 
@@ -279,22 +787,35 @@ def get_my_datasets():
 
 
 def get_datasets(user_id):
-    user_table = dynamodb.Table('user_table')
+    return entitlements.get(user_id)
+
 
-    response = user_table.query(
-        IndexName='users_username_index',
-        KeyConditionExpression=Key('username').eq(user_id)
-    )
+def load_datasets(user_id):
+    user = repository.users.find('username', user_id, ['datasets_purchased'])
 
     try:
-        datasets = set(response['Items'][0]['datasets_purchased'])
+        datasets = set(user['datasets_purchased'])
         return datasets
     except:
         return -1
 
 
+# The datasets each user purchased, reloaded in the background once older than ENTITLEMENT_REFRESH_SECONDS
+entitlements = EntitlementCache(
+    load_datasets,
+    maxsize=int(os.getenv('ENTITLEMENT_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('ENTITLEMENT_CACHE_SECONDS', '600')),
+    refresh_after=float(os.getenv('ENTITLEMENT_REFRESH_SECONDS', '60')),
+)
+# How often a user without the dataset they ask for has their entitlements looked up again
+ENTITLEMENT_RECHECK_SECONDS = float(os.getenv('ENTITLEMENT_RECHECK_SECONDS', '5'))
+
+
 def validate_user(dataset_id, user_id):
     datasets = get_datasets(user_id)
+    if datasets == -1 or dataset_id not in datasets:
+        # The dataset may have been purchased since the entitlements were cached
+        datasets = entitlements.reload(user_id, min_age=ENTITLEMENT_RECHECK_SECONDS)
     if datasets == -1:
         return False
     elif dataset_id in datasets:
@@ -302,37 +823,42 @@ def validate_user(dataset_id, user_id):
     return False
 
 
-def validate_api_key(api_key, dataset_id):
-    dataset_table = dynamodb.Table('dataset_table')
-    user_table = dynamodb.Table('user_table')
+def validate_api_key(api_key, dataset_id, dataset=None):
+    """ Checks an api key against the key of the dataset's owner. The dataset (its owner_username) can be passed in """
+    if not api_key:
+        return False
+
+    cached = api_key_cache.get(dataset_id, api_key)
+    if cached is not None:
+        return cached
+
     api_key_db = 0
-    try:
-        dataset_response = dataset_table.query(KeyConditionExpression=Key('dataset_id').eq(dataset_id))
-    except:
-        return jsonify({'error': 'failed to query dynamodb'})
+    if dataset is None:
+        try:
+            dataset = repository.datasets.get(dataset_id, ['owner_username'])
+        except:
+            return jsonify({'error': 'failed to query dynamodb'})
 
     try:
-        owner_username = dataset_response['Items'][0]['owner_username']
+        owner_username = dataset['owner_username']
     except:
+        api_key_cache.set(dataset_id, api_key, None, False)
         return jsonify({'error': 'owner not listed for provided dataset_id'})
 
     try:
-        user_response = user_table.query(
-            IndexName='users_username_index',
-            KeyConditionExpression=Key('username').eq(owner_username)
-        )
+        owner = repository.users.find('username', owner_username, ['api_key'])
     except:
         return jsonify({'error': 'failed to query dynamodb'})
 
     try:
-        api_key_db = user_response['Items'][0]['api_key']
+        api_key_db = owner['api_key']
     except:
+        api_key_cache.set(dataset_id, api_key, owner_username, False)
         return jsonify({'error': 'no api_key generated for user'})
 
-    if api_key_db == api_key:
-        return True
-    else:
-        return False
+    valid = api_key_db == api_key
+    api_key_cache.set(dataset_id, api_key, owner_username, valid)
+    return valid
 
 
 @app.after_request
@@ -340,47 +866,5 @@ def apply_caching(response):
     response.headers["Access-Control-Allow-Headers"] = '*'
     response.headers["Access-Control-Allow-Origin"] = '*'
     response.headers["Access-Control-Allow-Methods"] = 'POST, PUT, GET, HEAD, OPTIONS'
+    response.headers["Access-Control-Expose-Headers"] = 'ETag, X-Poll-Interval'
     return response
-
-
-def retrieve(user, model_id, version, node_url):
-
-    # 1. get pygrid model
-    payload = {
-        "name": model_id,
-        "version": version,
-        "checkpoint": "latest"
-    }
-
-    url = 'http://' + node_url + ":5000/model-centric/retrieve-model"
-    r = requests.get(url, params=payload)
-    
-    # perceptron-1.2.pkl
-    file_name = model_id + '-' + version + '.pkl'  # name of file
-    file_loc = '/tmp/' + file_name  # local save location
-    s3_loc = user + '/' + file_name  # location where file will be saved on S3 (under a user's directory)
-    th.save(r.content, file_loc)
-
-    # 2. Put model in s3 bucket
-    s3 = boto3.client('s3')
-    s3_bucket_name = "artificien-retrieved-models-storage"
-    s3.upload_file(file_loc, s3_bucket_name, s3_loc, ExtraArgs={'ACL': 'public-read'})  # Public download
-    print('Done uploading trained model to S3!')
-
-    # https://artificien-retrieved-models-storage.s3.amazonaws.com/technigala/perceptron1.2.pkl
-    bucket_url = 'https://' + s3_bucket_name + '.s3.amazonaws.com/' + s3_loc
-    
-    # 3. flip is_active boolean on model in dynamo
-    model_table = dynamodb.Table('model_table')
-
-    # 4. Add bucket URL to model in Dynamo
-    update_response = model_table.update_item(
-        Key={'model_id': model_id},
-        UpdateExpression="set download_link = :r",
-        ExpressionAttributeValues={
-            ':r': bucket_url,
-        },
-    )
-
-    if update_response:
-        print("UPDATE success")
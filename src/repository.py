@@ -0,0 +1,89 @@
+from boto3.dynamodb.conditions import Key
+from . import aws_clients
+
+
+def projection(fields):
+    """ A ProjectionExpression for fields, and its attribute names (as placeholders, so reserved words can be read) """
+    names = {'#p' + str(i): field for i, field in enumerate(fields)}
+    return ', '.join(names), names
+
+
+class Repository:
+    """
+    Reads and writes the items of a DynamoDB table by key. Reads only fetch the fields asked for and writes only send
+    the fields that change, so neither costs more as items grow. Primary key lookups are single GetItems; lookups by
+    another attribute go through the global secondary index keyed by it.
+    """
+
+    def __init__(self, table_name, key_name, indexes=None):
+        self.table_name = table_name
+        self.key_name = key_name
+        self.indexes = indexes or {}  # attribute -> the index keyed by it
+
+    def table(self):
+        return aws_clients.table(self.table_name)
+
+    def get(self, key, fields, consistent=False):
+        """ Returns the given fields of the item with this key, or None if there is none """
+        expression, names = projection(fields)
+        return self.table().get_item(
+            Key={self.key_name: key},
+            ProjectionExpression=expression,
+            ExpressionAttributeNames=names,
+            ConsistentRead=consistent,
+        ).get('Item')
+
+    def find(self, attribute, value, fields):
+        """ Returns the given fields of the first item whose (indexed) attribute has this value, or None """
+        expression, names = projection(fields)
+        items = self.table().query(
+            IndexName=self.indexes[attribute],
+            KeyConditionExpression=Key(attribute).eq(value),
+            ProjectionExpression=expression,
+            ExpressionAttributeNames=names,
+            Limit=1,
+        )['Items']
+        return items[0] if items else None
+
+    def update(self, key, fields=None, remove=(), condition=None, return_values=None):
+        """
+        Sets fields (a dict) on the item with this key and removes the `remove` fields from it, in a single UpdateItem.
+        Returns the item's attributes asked for by return_values, if any
+        """
+        names = {}
+        values = {}
+        actions = []
+
+        sets = []
+        for i, (field, value) in enumerate((fields or {}).items()):
+            names['#s' + str(i)] = field
+            values[':s' + str(i)] = value
+            sets.append('#s{0} = :s{0}'.format(i))
+        if sets:
+            actions.append('SET ' + ', '.join(sets))
+
+        removes = []
+        for i, field in enumerate(remove):
+            names['#r' + str(i)] = field
+            removes.append('#r' + str(i))
+        if removes:
+            actions.append('REMOVE ' + ', '.join(removes))
+
+        update_args = {
+            'Key': {self.key_name: key},
+            'UpdateExpression': ' '.join(actions),
+            'ExpressionAttributeNames': names,
+        }
+        if values:
+            update_args['ExpressionAttributeValues'] = values
+        if condition is not None:
+            update_args['ConditionExpression'] = condition
+        if return_values is not None:
+            update_args['ReturnValues'] = return_values
+
+        return self.table().update_item(**update_args).get('Attributes')
+
+
+models = Repository('model_table', 'model_id', indexes={'dataset': 'models_dataset_index'})
+datasets = Repository('dataset_table', 'dataset_id')
+users = Repository('user_table', 'user_id', indexes={'username': 'users_username_index'})
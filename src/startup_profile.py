@@ -0,0 +1,99 @@
+import os
+import sys
+import time
+import json
+import threading
+
+# How long a worker may take from starting to import the app to serving its first request
+budget = float(os.getenv('STARTUP_BUDGET_SECONDS', '5'))
+
+started = None
+import_times = {}  # module name -> seconds spent importing it, excluding its own imports
+stack = []  # [module name, start time, seconds spent in nested imports]
+lock = threading.Lock()
+
+
+class TimedLoader:
+    """ Wraps a module loader to time how long executing the module takes """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        frame = [module.__name__, time.perf_counter(), 0.0]
+        stack.append(frame)
+        try:
+            self.loader.exec_module(module)
+        finally:
+            stack.pop()
+            elapsed = time.perf_counter() - frame[1]
+            import_times[frame[0]] = elapsed - frame[2]
+            if stack:
+                stack[-1][2] += elapsed
+
+
+class TimedFinder:
+    """ A meta path finder that defers to the real finders, and times the modules they load """
+
+    @classmethod
+    def find_spec(cls, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is cls or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = TimedLoader(spec.loader)
+                return spec
+        return None
+
+
+def begin():
+    """ Starts profiling. Must be called before the app is imported """
+    global started
+    started = time.perf_counter()
+    sys.meta_path.insert(0, TimedFinder)
+
+
+def watch_first_request(app):
+    """ Reports the startup profile when the app serves its first request """
+    reported = []
+
+    @app.before_request
+    def report_startup_profile():
+        if reported:
+            return
+        with lock:
+            if reported:
+                return
+            reported.append(True)
+        report()
+
+
+def report(top=25):
+    """ Prints the modules that were slowest to import, and the time to first request, as a JSON line """
+    if TimedFinder in sys.meta_path:
+        sys.meta_path.remove(TimedFinder)
+
+    time_to_first_request = time.perf_counter() - started
+    slowest = sorted(import_times.items(), key=lambda item: item[1], reverse=True)[:top]
+    print(json.dumps({
+        'startup_profile': {
+            'pid': os.getpid(),
+            'time_to_first_request': round(time_to_first_request, 4),
+            'import_time': round(sum(import_times.values()), 4),
+            'budget': budget,
+            'within_budget': time_to_first_request <= budget,
+            'slowest_imports': [{'module': name, 'seconds': round(seconds, 4)} for name, seconds in slowest],
+        }
+    }))
+
+    if time_to_first_request > budget:
+        print('WARNING: worker took', round(time_to_first_request, 2), 'seconds to serve its first request, over the',
+              budget, 'second startup budget')
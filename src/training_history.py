@@ -0,0 +1,96 @@
+import math
+import time
+from decimal import Decimal
+from boto3.dynamodb.conditions import Key
+from . import aws_clients
+
+# The arrays of a bucket (placeholders, as some of the names are reserved words in DynamoDB expressions)
+SERIES_NAMES = {'#t': 't', '#loss': 'loss', '#acc': 'acc', '#devices': 'devices'}
+
+
+class TrainingHistory:
+    """
+    Keeps the aggregate loss, accuracy and device count of every finished training cycle of a model.
+
+    Cycles are stored in time buckets of bucket_seconds: one item per model per bucket (keyed by model_id and the
+    bucket's start time), holding parallel arrays of the cycles' end times, losses, accuracies and device counts.
+    Each cycle is appended with a single UpdateItem, and a model's whole curve is read back with a single query.
+    """
+
+    def __init__(self, table_name='model_metrics_table', bucket_seconds=86400):
+        self.table_name = table_name
+        self.bucket_seconds = bucket_seconds
+
+    def record(self, model_id, loss, acc, devices, when=None):
+        """ Appends a finished cycle to the model's history """
+        when = int(when or time.time())
+        aws_clients.table(self.table_name).update_item(
+            Key={'model_id': model_id, 'bucket': when - when % self.bucket_seconds},
+            UpdateExpression='SET #t = list_append(if_not_exists(#t, :empty), :t), '
+                             '#loss = list_append(if_not_exists(#loss, :empty), :loss), '
+                             '#acc = list_append(if_not_exists(#acc, :empty), :acc), '
+                             '#devices = list_append(if_not_exists(#devices, :empty), :devices)',
+            ExpressionAttributeNames=SERIES_NAMES,
+            ExpressionAttributeValues={
+                ':empty': [],
+                ':t': [when],
+                ':loss': [Decimal(str(round(loss, 6)))],
+                ':acc': [Decimal(str(round(acc, 6)))],
+                ':devices': [int(devices)],
+            },
+        )
+
+    def curves(self, model_id, since=None, until=None, points=None):
+        """
+        Returns the model's cycles between since and until (unix times) as {'t', 'loss', 'acc', 'devices'} lists,
+        averaged down to at most `points` points if given.
+        """
+        key_condition = Key('model_id').eq(model_id)
+        if since is not None or until is not None:
+            since = int(since or 0)
+            until = int(until if until is not None else time.time())
+            key_condition = key_condition & Key('bucket').between(since - since % self.bucket_seconds, until)
+
+        query_args = {
+            'KeyConditionExpression': key_condition,
+            'ProjectionExpression': ', '.join(SERIES_NAMES),
+            'ExpressionAttributeNames': dict(SERIES_NAMES),  # boto3 adds the key condition's names to it
+        }
+
+        series = {'t': [], 'loss': [], 'acc': [], 'devices': []}
+        while True:
+            response = aws_clients.table(self.table_name).query(**query_args)
+            for bucket in response['Items']:
+                for name, values in series.items():
+                    values.extend(bucket.get(name, []))
+
+            # Results are paginated past 1 MB
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_args['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+        series = {name: [float(value) if name in ('loss', 'acc') else int(value) for value in values]
+                  for name, values in series.items()}
+        if since is not None:
+            keep = [i for i, t in enumerate(series['t']) if since <= t <= until]
+            series = {name: [values[i] for i in keep] for name, values in series.items()}
+
+        return downsample(series, points)
+
+
+def downsample(series, points):
+    """ Averages consecutive cycles together so that at most `points` remain. Each point keeps its last cycle's time """
+    cycles = len(series['t'])
+    if not points or points <= 0 or cycles <= points:
+        return series
+
+    size = int(math.ceil(cycles / float(points)))
+    downsampled = {name: [] for name in series}
+    for start in range(0, cycles, size):
+        end = min(start + size, cycles)
+        for name, values in series.items():
+            if name == 't':
+                downsampled[name].append(values[end - 1])
+            else:
+                downsampled[name].append(sum(values[start:end]) / (end - start))
+    return downsampled
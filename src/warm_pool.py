@@ -0,0 +1,191 @@
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import ClientError
+from . import aws_clients
+
+# Warm pool slot states
+EMPTY = 'empty'
+LAUNCHING = 'launching'
+WARM = 'warm'
+
+# Pool node stacks are named pygrid-warm-<slot>-<suffix>, so a stack's slot can be told from its name
+STACK_PREFIX = 'pygrid-warm-'
+
+
+def is_conditional_failure(exe):
+    return exe.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+class WarmPool:
+    """
+    Keeps `size` pygrid nodes (of the default size profile) deployed, healthy and not yet assigned to any dataset, so
+    that /create can hand one to a new dataset at once instead of waiting minutes for a stack to deploy.
+
+    The pool is `size` slot items ('slot-0', 'slot-1', ...) in the node pool table, each empty, launching or holding a
+    warm node. Every change to a slot is a conditional write, so however many workers share the pool, each slot is
+    only refilled once and each warm node is only claimed once. Launched stacks are handed to a StackTracker, whose
+    callbacks should call node_ready/node_failed for the stacks this pool owns.
+
+    Besides after each claim and failed launch, the pool is refilled every refill_interval seconds, which also picks
+    up slots emptied by other workers.
+    """
+
+    def __init__(self, stack_tracker, size=0, table_name='node_pool_table', refill_interval=300):
+        self.stack_tracker = stack_tracker
+        self.size = size
+        self.table_name = table_name
+        self.refill_interval = refill_interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='warm-pool')
+        self.thread = None
+
+    def start(self):
+        """ Refills the pool in the background (now and periodically), resuming tracking the nodes it still launches """
+        if self.size <= 0:
+            return
+
+        self.executor.submit(self.run, self.refill)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.refill_periodically, name='warm-pool-refill', daemon=True)
+            self.thread.start()
+
+    def refill_periodically(self):
+        while True:
+            # Jittered, so that the workers sharing the pool don't all refill at once
+            time.sleep(self.refill_interval * random.uniform(0.5, 1.5))
+            self.executor.submit(self.run, self.refill)
+
+    def owns(self, stack_name):
+        return stack_name.startswith(STACK_PREFIX)
+
+    def slots(self):
+        # The table only ever holds `size` small items, so reading all of it is cheap
+        return aws_clients.table(self.table_name).scan(ConsistentRead=True)['Items']
+
+    def claim(self, dataset_id):
+        """
+        Takes a warm node out of the pool for a dataset, returning its (stack_name, node_url), or None if no node is
+        warm. The node's stack keeps its pool name and only its NodeId parameter is set to the dataset. The pool is
+        refilled in the background.
+        """
+        if self.size <= 0:
+            return None
+
+        for slot in self.slots():
+            if slot.get('node_state') != WARM:
+                continue
+
+            try:
+                aws_clients.table(self.table_name).update_item(
+                    Key={'node_id': slot['node_id']},
+                    UpdateExpression='SET node_state = :empty, updated = :now REMOVE stack_name, nodeURL',
+                    ConditionExpression='node_state = :warm AND stack_name = :stack',
+                    ExpressionAttributeValues={
+                        ':empty': EMPTY, ':warm': WARM, ':stack': slot['stack_name'], ':now': int(time.time()),
+                    },
+                )
+            except ClientError as exe:
+                if is_conditional_failure(exe):
+                    continue  # another worker claimed it first
+                raise
+
+            print('Bound warm node', slot['stack_name'], 'to', dataset_id)
+            self.executor.submit(self.run, self.configure, slot['stack_name'], dataset_id)
+            self.executor.submit(self.run, self.refill)
+            return slot['stack_name'], slot['nodeURL']
+
+        return None
+
+    def run(self, task, *args, **kwargs):
+        try:
+            task(*args, **kwargs)
+        except BaseException as exe:
+            print('Warm pool', task.__name__, 'failed:', exe)
+
+    def configure(self, stack_name, dataset_id):
+        """ Sets a claimed node's NODE_ID to its dataset. Its address doesn't change while the task is replaced """
+        aws_clients.cloudformation().update_stack(
+            StackName=stack_name,
+            UsePreviousTemplate=True,
+            Parameters=[
+                {'ParameterKey': 'NodeId', 'ParameterValue': dataset_id.lower()},
+                {'ParameterKey': 'MasterNodeUrl', 'UsePreviousValue': True},
+            ],
+            Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'],
+        )
+
+    def refill(self):
+        """ Launches a node into every empty slot this worker manages to reserve """
+        from .orchestration_helper import AppFactory
+
+        slots = {slot['node_id']: slot for slot in self.slots()}
+        for i in range(self.size):
+            slot = slots.get('slot-' + str(i), {})
+            if slot.get('node_state') == LAUNCHING:
+                self.stack_tracker.watch(slot['stack_name'])
+            elif slot.get('node_state', EMPTY) == EMPTY:
+                stack_name = self.reserve(i)
+                if stack_name is None:
+                    continue
+
+                try:
+                    AppFactory.launch_node(stack_name)
+                except BaseException:
+                    self.release(stack_name)
+                    raise
+                print('Launching warm node', stack_name)
+                self.stack_tracker.watch(stack_name)
+
+    def reserve(self, i):
+        """ Marks an empty slot as launching a new node, returning the node's stack name if no other worker did first """
+        stack_name = STACK_PREFIX + str(i) + '-' + uuid.uuid4().hex[:8]
+        try:
+            aws_clients.table(self.table_name).update_item(
+                Key={'node_id': 'slot-' + str(i)},
+                UpdateExpression='SET node_state = :launching, stack_name = :stack, updated = :now',
+                ConditionExpression='attribute_not_exists(node_state) OR node_state = :empty',
+                ExpressionAttributeValues={
+                    ':launching': LAUNCHING, ':empty': EMPTY, ':stack': stack_name, ':now': int(time.time()),
+                },
+            )
+        except ClientError as exe:
+            if is_conditional_failure(exe):
+                return None
+            raise
+        return stack_name
+
+    def node_ready(self, stack_name, node_url):
+        """ Called once a pool node's stack has deployed """
+        self.set_slot(stack_name, LAUNCHING, WARM, node_url)
+
+    def node_failed(self, stack_name, status):
+        """ Called if a pool node failed to deploy. Its slot is emptied and refilled with a new node """
+        print('Warm node', stack_name, 'failed to deploy:', status)
+        self.release(stack_name)
+        if status != 'DOES_NOT_EXIST':
+            self.executor.submit(self.run, aws_clients.cloudformation().delete_stack, StackName=stack_name)
+        self.executor.submit(self.run, self.refill)
+
+    def release(self, stack_name):
+        self.set_slot(stack_name, LAUNCHING, EMPTY)
+
+    def set_slot(self, stack_name, from_state, to_state, node_url=None):
+        slot_id = 'slot-' + stack_name[len(STACK_PREFIX):].split('-')[0]
+        update_expression = 'SET node_state = :to, updated = :now'
+        values = {':to': to_state, ':from': from_state, ':stack': stack_name, ':now': int(time.time())}
+        if node_url is not None:
+            update_expression += ', nodeURL = :url'
+            values[':url'] = node_url
+
+        try:
+            aws_clients.table(self.table_name).update_item(
+                Key={'node_id': slot_id},
+                UpdateExpression=update_expression,
+                ConditionExpression='node_state = :from AND stack_name = :stack',
+                ExpressionAttributeValues=values,
+            )
+        except ClientError as exe:
+            if not is_conditional_failure(exe):
+                raise
@@ -1,4 +1,15 @@
+import os
+
+# Set STARTUP_PROFILE=True to report per-module import times and the time to first request of each worker
+profile_startup = os.getenv('STARTUP_PROFILE') == 'True'
+if profile_startup:
+    from . import startup_profile
+    startup_profile.begin()
+
 from .pygrid_orchestration import app
 
+if profile_startup:
+    startup_profile.watch_first_request(app)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001)